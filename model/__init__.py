@@ -10,3 +10,24 @@ Statistics = namedtuple("Statistics",
                         ["likelihood", "user_likelihood", "location_likelihood",
                          "topic_likelihood", "sigma_likelihood", "phi_entropy", "eta_penalty",
                          "topic_centers", "topic_covar", "phi"])
+
+GeoFactors = namedtuple("GeoFactors",
+                        ["topic_centers", "topic_covar", "precision", "log_norm"])
+
+LogLikelihoodTerms = namedtuple("LogLikelihoodTerms",
+                                ["feature_log_likelihood", "location_log_likelihood", "location_log_likelihood_sum"],
+                                defaults=(None,))
+
+BoundTerms = namedtuple("BoundTerms",
+                        ["user_likelihood", "location_likelihood", "topic_likelihood", "phi_log_phi", "phi_sum"])
+
+SufficientStatistics = namedtuple("SufficientStatistics",
+                                  ["sum_phi", "sum_phi_squared", "sum_phi_coordinates", "sum_phi_outer",
+                                   "sparse_and_phi"])
+
+EMState = namedtuple("EMState",
+                     ["theta", "topic_centers", "topic_covar", "h_arrays", "beta_arrays", "geo_factors", "log_terms",
+                      "phi", "statistics"])
+
+ShardSummary = namedtuple("ShardSummary",
+                          ["num_points", "counts"])
@@ -0,0 +1,182 @@
+import sys
+
+import numpy as np
+import scipy.optimize as optimize
+from joblib import Parallel, delayed, effective_n_jobs
+
+from model import utils
+
+_EPSILON = 1e-10
+
+
+def compute_log_beta(m_array, h_array):
+    """
+    m_array: 1 x V
+    h_array: k x V
+    log_beta: k x V
+    """
+    beta_array = m_array + h_array
+    norm_sum = utils.log_sum(beta_array, axis=1)
+
+    return beta_array - norm_sum[:, np.newaxis]
+
+
+def smooth_objective(sparse_and_phi, m_array, h_array):
+    """
+    Per topic negative expected log-likelihood of the unigrams, i.e. the smooth part of the eta objective.
+
+    sparse_and_phi: k x V
+    :return: k
+    """
+    return -1.0 * np.sum(compute_log_beta(m_array, h_array) * sparse_and_phi, axis=1)
+
+
+def soft_threshold(h_array, threshold):
+    """
+    Proximal operator of threshold * |h|, applied element-wise.
+
+    threshold: scalar or k x 1
+    """
+    return np.sign(h_array) * np.maximum(np.abs(h_array) - threshold, 0.0)
+
+
+def conjugate_gradient_l1(sparse_and_phi, m_array, h_array, Lambda, max_iterations=None, tolerance=_EPSILON,
+                          disp=False):
+    """
+    Uses conjugate gradient descent from scipy with sign subgradients to find the best eta array. Topics are
+    optimized one at a time, so that each of them stops on its own convergence.
+
+    sparse_and_phi: k x V, expected unigram counts per topic
+    m_array: 1 x V
+    h_array: k x V, used as a warm start
+    :return: updated h_array (k x V)
+    """
+    h_upd = np.array(h_array, dtype=float)
+
+    for z in range(h_upd.shape[0]):
+        # also equals "e" in the derivative
+        topic_and_phi = sparse_and_phi[z:z + 1]
+        e = np.sum(topic_and_phi)
+
+        def l_prime(h_new):
+            new_beta = np.exp(compute_log_beta(m_array, h_new[np.newaxis, :]))
+            g = Lambda * np.sign(h_new) + e * new_beta - topic_and_phi  # multiplied by -1 to maximize
+
+            return g.flatten()
+
+        def f(h_new):
+            result = np.sum(compute_log_beta(m_array, h_new[np.newaxis, :]) * topic_and_phi) - Lambda * np.sum(
+                np.abs(h_new))
+
+            return -1.0 * result
+
+        h_upd[z] = optimize.fmin_cg(f, h_upd[z], fprime=l_prime, gtol=tolerance, norm=np.inf,
+                                    maxiter=max_iterations, disp=disp)
+
+    return h_upd
+
+
+def fista_l1(sparse_and_phi, m_array, h_array, Lambda, max_iterations=1000, tolerance=1e-6, disp=False):
+    """
+    Minimizes -sum(log(beta) * sparse_and_phi) + Lambda * |h| with accelerated proximal gradient descent (FISTA),
+    starting from the given h_array. The objective is separable over topics, so every topic keeps its own step size
+    (found by backtracking) and momentum, and stops iterating as soon as it has converged. The L1 penalty is handled
+    by soft thresholding, which gives exact zeros.
+
+    sparse_and_phi: k x V, expected unigram counts per topic
+    m_array: 1 x V
+    h_array: k x V, used as a warm start
+    :return: updated h_array (k x V)
+    """
+    E = np.sum(sparse_and_phi, axis=1)[:, np.newaxis]  # k x 1
+
+    h = np.array(h_array, dtype=float)
+    y = h.copy()
+    t = np.ones((h.shape[0], 1))
+
+    # Lipschitz estimates of the gradient, the Hessian of row z is bounded by E_z * (diag(beta_z) - beta_z beta_z')
+    lipschitz = np.maximum(E * np.minimum(np.max(np.exp(compute_log_beta(m_array, h)), axis=1, keepdims=True), 0.5),
+                           _EPSILON)
+
+    active = np.arange(h.shape[0])
+    num_iterations = np.zeros(h.shape[0], dtype=int)
+
+    for iteration in range(max_iterations):
+        if len(active) == 0:
+            break
+
+        a_phi, a_E, a_h, a_y, a_t, a_lipschitz = \
+            sparse_and_phi[active], E[active], h[active], y[active], t[active], lipschitz[active]
+
+        log_beta_y = compute_log_beta(m_array, a_y)
+        f_y = -1.0 * np.sum(log_beta_y * a_phi, axis=1, keepdims=True)  # k x 1
+        grad_y = a_E * np.exp(log_beta_y) - a_phi  # k x V
+
+        # Backtracking: increase the Lipschitz estimate of the topics without sufficient decrease
+        h_new = soft_threshold(a_y - grad_y / a_lipschitz, Lambda / a_lipschitz)
+        for backtrack in range(50):
+            diff = h_new - a_y
+            upper_bound = f_y + np.sum(grad_y * diff, axis=1, keepdims=True) \
+                          + 0.5 * a_lipschitz * np.sum(diff * diff, axis=1, keepdims=True)
+            f_new = smooth_objective(a_phi, m_array, h_new)[:, np.newaxis]
+
+            insufficient = (f_new > upper_bound + _EPSILON * np.abs(upper_bound)).flatten()
+            if not np.any(insufficient):
+                break
+
+            a_lipschitz[insufficient] *= 2.0
+            h_new[insufficient] = soft_threshold(a_y[insufficient] - grad_y[insufficient] / a_lipschitz[insufficient],
+                                                 Lambda / a_lipschitz[insufficient])
+
+        # Momentum, restarted for topics where it points against the proximal step
+        t_new = 0.5 * (1.0 + np.sqrt(1.0 + 4.0 * a_t * a_t))
+        restart = np.sum((a_y - h_new) * (h_new - a_h), axis=1, keepdims=True) > 0
+        t_new[restart] = 1.0
+
+        change = np.max(np.abs(h_new - a_h), axis=1)
+
+        y[active] = h_new + np.where(restart, 0.0, (a_t - 1.0) / t_new) * (h_new - a_h)
+        h[active] = h_new
+        t[active] = t_new
+        lipschitz[active] = a_lipschitz
+        num_iterations[active] += 1
+
+        active = active[change >= tolerance]
+
+    if disp:
+        print("FISTA iterations per topic: {0}".format(num_iterations.tolist()), file=sys.stderr)
+
+    return h
+
+
+SOLVERS = {"cg": conjugate_gradient_l1, "fista": fista_l1}
+
+
+def solve(solver, sparse_and_phi, m_array, h_array, Lambda, n_jobs=1, backend="threading", disp=False):
+    """
+    Updates the eta array of a feature. The eta objective is a sum of independent per-topic terms, so the topics are
+    split into blocks that are solved in parallel by a joblib pool.
+
+    :param solver: name of the solver, one of SOLVERS
+    :param sparse_and_phi: k x V, expected unigram counts per topic (phi * sparse_doc_term_matrix)
+    :param m_array: 1 x V
+    :param h_array: k x V, used as a warm start
+    :param n_jobs: number of workers, as in joblib; 1 solves all topics in the calling thread
+    :param backend: joblib backend, "threading" or a process-based backend like "loky"
+    :return: updated h_array (k x V)
+    """
+    solver_function = SOLVERS[solver]
+
+    k = h_array.shape[0]
+    num_blocks = min(k, 4 * effective_n_jobs(n_jobs)) if n_jobs != 1 else 1
+
+    if num_blocks <= 1:
+        return solver_function(sparse_and_phi, m_array, h_array, Lambda, disp=disp)
+
+    blocks = np.array_split(np.arange(k), num_blocks)
+
+    h_blocks = Parallel(n_jobs=n_jobs, backend=backend)(
+        delayed(solver_function)(sparse_and_phi[block], m_array, h_array[block], Lambda, disp=disp)
+        for block in blocks)
+
+    return np.vstack(h_blocks)
@@ -19,13 +19,14 @@ from sklearn.decomposition import TruncatedSVD
 import numpy as np
 
 
-def get_sparse_occur_matrix(words, unigram_ids):
-    # a sparse N x V matrix
-    doc_sparse = sparse.lil_matrix((len(words), len(unigram_ids)))
-    for d, venue in enumerate(words):
-        for w in venue:
-            doc_sparse[d, unigram_ids[w]] += 1.0
-    return doc_sparse.tocsr()
+def get_sparse_occur_matrix(words, unigram_ids, dtype=np.float64):
+    # a sparse N x V matrix of counts of the given dtype, scipy uses int32 indices whenever they fit
+    rows = np.fromiter((d for d, venue in enumerate(words) for _ in venue), dtype=np.int64)
+    columns = np.fromiter((unigram_ids[w] for venue in words for w in venue), dtype=np.int64)
+
+    # duplicates are summed into counts
+    return sparse.csr_matrix((np.ones(len(rows), dtype=dtype), (rows, columns)),
+                             shape=(len(words), len(unigram_ids)), dtype=dtype)
 
 
 def load_data_csv(datafile):
@@ -144,7 +145,7 @@ def fetch_data_from_mongo(venue_collection, checkin_collection, venue_filter_que
 def load_data_mongo(venue_collection, checkin_collection, venue_filter_query,
                     venue_feature_extractors, checkin_feature_extractors,
                     filename_prefix: str, num_svd_components: int,
-                    venue_threshold: int):
+                    venue_threshold: int, dtype=np.float64):
     data = fetch_data_from_mongo(venue_collection, checkin_collection, venue_filter_query,
                                  venue_feature_extractors, checkin_feature_extractors,
                                  venue_threshold)
@@ -156,13 +157,14 @@ def load_data_mongo(venue_collection, checkin_collection, venue_filter_query,
 
     print("Processed {0} venues.".format(data["coordinates"].shape[0]),
           file=sys.stderr)
-    return sparsify_data(data, filename_prefix, num_svd_components), scaler
+    return sparsify_data(data, filename_prefix, num_svd_components, dtype), scaler
 
 
-def sparsify_data(data: dict, filename_prefix: str, num_svd_components: int):
+def sparsify_data(data: dict, filename_prefix: str, num_svd_components: int, dtype=np.float64):
     """
     Converts raw data to sparse matrices.
     :param data:
+    :param dtype: type of the sparse matrices, np.float32 for a model computing in float32
     :return:
     """
     sparsified = {"coordinates": data["coordinates"], "unigrams": {}, "counts": {},
@@ -177,13 +179,13 @@ def sparsify_data(data: dict, filename_prefix: str, num_svd_components: int):
         sparsified["counts"][feature] = list(counter.values())
         sparsified["unigrams"][feature] = list(counter.keys())
         unigram_ids = dict([(w, i) for i, w in enumerate(sparsified["unigrams"][feature])])
-        sparsified[feature] = get_sparse_occur_matrix(data[feature], unigram_ids)
+        sparsified[feature] = get_sparse_occur_matrix(data[feature], unigram_ids, dtype)
         if num_svd_components is not None and feature == "user":
             print("Running SVD for user and keeping {0} components...".format(num_svd_components))
             reduced = reduce_dim(sparsified[feature], data[feature],
                                  sparsified["unigrams"][feature],
                                  num_svd_components,
-                                 filename_prefix)
+                                 filename_prefix, dtype)
             print("Size before SVD: {0}".format(sparsified[feature].shape))
             print("Size after SVD: {0}".format(reduced.shape))
 
@@ -195,7 +197,7 @@ def sparsify_data(data: dict, filename_prefix: str, num_svd_components: int):
     return sparsified
 
 
-def reduce_dim(sparse_matrix, raw_data, unigrams, n: int, filename_prefix: str):
+def reduce_dim(sparse_matrix, raw_data, unigrams, n: int, filename_prefix: str, dtype=np.float64):
     """
     Applies truncated SVD to given sparse matrix and "clusters" each word according to
     the component that "leans" most in its direction.
@@ -211,6 +213,7 @@ def reduce_dim(sparse_matrix, raw_data, unigrams, n: int, filename_prefix: str):
     These will be used to create a mapping file from word to super-word
     :param n: number of components
     :param filename_prefix: assignment vector will be saved with this prefix
+    :param dtype: type of the reduced matrix
     :return: reduced feature matrix where each column is a new "super-word"
     """
     svd = TruncatedSVD(n_components=n)
@@ -218,7 +221,7 @@ def reduce_dim(sparse_matrix, raw_data, unigrams, n: int, filename_prefix: str):
     maximums = np.argmax(np.abs(svd.components_), axis=0)
     unigram_feat_map = dict([(unigrams[i], maximums[i]) for i in range(len(maximums))])
 
-    reduced = get_sparse_occur_matrix(raw_data, unigram_feat_map)[:, 0:n]
+    reduced = get_sparse_occur_matrix(raw_data, unigram_feat_map, dtype)[:, 0:n]
     # num_points, _ = sparse_matrix.shape
     # counts = sparse.csc_matrix((num_points, n), dtype=int)
     #
@@ -346,3 +349,21 @@ def save_model(model: Model, scaler: StandardScaler, query: str, unigrams: dict,
         if query is not None: desc_file.write("Query: {0}\n".format(query))
         if per_point_test_likelihood is not None:
             desc_file.write("Test Likelihood per point: {}\n".format(per_point_test_likelihood))
+
+
+def load_model(filename_prefix: str):
+    """
+    Loads a model saved with save_model.
+    :param filename_prefix: prefix of the .mdl, .scaler and .unigrams files
+    :return: the model, the scaler of its coordinates and the unigrams it was trained on
+    """
+    with open(filename_prefix + ".mdl", "rb") as model_file:
+        model = pickle.load(model_file)
+
+    with open(filename_prefix + ".scaler", "rb") as scaler_file:
+        scaler = pickle.load(scaler_file)
+
+    with open(filename_prefix + ".unigrams", "rb") as unigram_file:
+        unigrams = pickle.load(unigram_file)
+
+    return model, scaler, unigrams
@@ -1,17 +1,48 @@
+import os
+import pickle
 import sys
+import time
 import traceback
 from copy import copy
 
 import numpy as np
-import scipy.optimize as optimize
-import scipy.stats as stats
+import scipy.special as special
+from joblib import Parallel, delayed, effective_n_jobs
+from scipy import sparse
+from sklearn.cluster import MiniBatchKMeans
+from sklearn.preprocessing import normalize
 
-from model import utils, Statistics, ModelParameters
+from model import eta, utils, Statistics, ModelParameters, GeoFactors, LogLikelihoodTerms, BoundTerms, \
+    SufficientStatistics, EMState
+from model.workspace import Workspace
 
 __author__ = 'emre'
 
 _EPSILON = 1e-10
 
+ETA_SOLVERS = tuple(eta.SOLVERS.keys())
+
+INITIALIZATIONS = ("random", "kmeans")
+
+# Topics with less phi mass than that many points have collapsed and are re-seeded
+_MIN_TOPIC_MASS = 1.0
+
+# Mini-batch k-means warm-up of the "kmeans" initialization
+_KMEANS_BATCH_SIZE = 1024
+_KMEANS_ITERATIONS = 10
+
+# k x chunk float temporaries alive at once in a chunked pass over the venues, see Model.memory_budget
+_CHUNK_TEMPORARIES = 5
+
+# Venues per chunk of a float32 phi that is copied to float64 for the sufficient statistics
+_FLOAT64_CHUNK_SIZE = 8192
+
+# Venues per block of the transposed sparse products of the log-likelihood terms
+_TRANSPOSE_CHUNK_SIZE = 4096
+
+# Venues drawn from the shards of sharded EM for the initialization, see Model.fit_sharded
+_SHARD_SAMPLE_SIZE = 10000
+
 
 # Lambda = 1
 
@@ -20,7 +51,12 @@ _EPSILON = 1e-10
 class Model:
     def __init__(self, Lambda, num_topics, max_iterations, minimum_relative_change,
                  initial_topic_centers=None, initial_topic_covar=None,
-                 track_params=False, verbose=0):
+                 track_params=False, verbose=0, eta_solver="cg", eta_n_jobs=1, eta_backend="threading",
+                 feature_n_jobs=1, random_state=None, em_acceleration=False, initialization="random",
+                 initialization_feature_weight=0.0, min_variance=1e-6, min_topic_proportion=0.0,
+                 merge_distance=0.0, max_topics_per_point=None, min_responsibility=0.0, spatial_tolerance=None,
+                 memory_budget=None, dtype=np.float64, checkpoint_path=None, checkpoint_every=None,
+                 checkpoint_seconds=None):
         """
         Creates a probabilistic model for modelling regions with topics on geospatial data.
 
@@ -35,11 +71,91 @@ class Model:
 
         :param verbose: if 0, nothing will be displayed; if 1, iteration numbers will be displayed on stderr;
         if 2, will print lots of tracking information
+
+        :param eta_solver: optimizer for the L1-penalized eta (h_arrays) update, one of ETA_SOLVERS. "cg" runs
+        conjugate gradient descent with sign subgradients, "fista" runs proximal gradient descent warm-started from
+        the previous h_arrays
+
+        :param eta_n_jobs: number of workers solving the independent per-topic eta problems, as in joblib
+        :param eta_backend: joblib backend of those workers, "threading" or a process-based backend like "loky"
+
+        :param feature_n_jobs: number of threads updating the eta and beta arrays of different features concurrently,
+        as in joblib. BLAS threads are limited so that, together with eta_n_jobs, the cores are not oversubscribed
+
+        :param random_state: np.random.Generator (or RandomState) for the random initialization and the order of
+        mini-batches. If None, the global numpy random state is used
+
+        :param em_acceleration: if True, full-batch EM is accelerated with SQUAREM, which extrapolates two EM steps and
+        falls back to the plain steps whenever the bound would decrease. Iterations then count EM steps
+
+        :param initialization: initialization of the regions that are not user-supplied, one of INITIALIZATIONS.
+        "random" draws centers around the mean of the data and random diagonal covariances, "kmeans" seeds centers
+        with k-means++ and refines them with a few mini-batch k-means iterations. The clusters then give the
+        covariances, theta and a first M-step of the eta arrays
+        :param initialization_feature_weight: weight of the L2-normalized feature rows next to the standardized
+        coordinates in the k-means space, 0 clusters the coordinates only
+
+        :param min_variance: floor of the eigenvalues of the topic covariances, in standardized coordinates. Learned
+        covariances are raised to it, so that topics on a few locations do not become singular
+
+        :param min_topic_proportion: after every iteration (pass for stochastic EM), topics whose theta is below it are
+        dropped, so that they do not cost anything in the next ones. Collapsed topics are then dropped instead of being
+        re-seeded. 0 keeps all topics
+        :param merge_distance: after every iteration, pairs of topics whose Gaussians are closer than that Bhattacharyya
+        distance are merged into one topic. 0 never merges, nor do user-supplied regions
+
+        :param max_topics_per_point: if given, the E-step keeps the responsibilities of that many most likely topics
+        per point only, renormalized, and phi is a sparse k x N matrix that the M-step consumes directly
+        :param min_responsibility: if positive, the E-step also drops the responsibilities below it, and phi is sparse
+
+        :param spatial_tolerance: if given, the training E-step only evaluates the topics of every point where the
+        topic density is at least spatial_tolerance times its peak, see compute_sparse_log_terms. phi is then sparse
+
+        :param memory_budget: if given, bytes of k x N temporaries that the log-likelihood terms, the E-step, the
+        likelihood and the covariance update may allocate on top of phi and the log-likelihood terms themselves. They
+        then process the venues in chunks that fit in it, writing into their k x N results in place. None processes
+        all venues at once
+
+        :param dtype: floating point type of phi, the log-likelihood terms and the beta arrays, np.float32 halves their
+        memory and bandwidth. The sparse feature matrices should have the same type, see io.sparsify_data. Sums over
+        points are accumulated in float64, and the topic Gaussians, theta and the eta arrays stay in float64
+
+        :param checkpoint_path: if given, the state of training is saved to that file with save_checkpoint while EM
+        runs, and when it stops. A run that dies can go on from there with load_checkpoint and resume
+        :param checkpoint_every: number of iterations (passes for stochastic EM) between checkpoints
+        :param checkpoint_seconds: seconds between checkpoints, checked after every iteration. If neither is given, a
+        checkpoint is saved after every iteration
         """
+        if eta_solver not in ETA_SOLVERS:
+            raise ValueError("Unknown eta solver {0}, expected one of {1}".format(eta_solver, ETA_SOLVERS))
+        if initialization not in INITIALIZATIONS:
+            raise ValueError("Unknown initialization {0}, expected one of {1}".format(initialization, INITIALIZATIONS))
+        if not np.issubdtype(dtype, np.floating):
+            raise ValueError("Expected a floating point dtype, got {0}".format(dtype))
+
         self.Lambda = Lambda
         self.num_topics = num_topics
         self.max_iterations = max_iterations
         self.minimum_relative_change = minimum_relative_change
+        self.eta_solver = eta_solver
+        self.eta_n_jobs = eta_n_jobs
+        self.eta_backend = eta_backend
+        self.feature_n_jobs = feature_n_jobs
+        self.random_state = random_state
+        self.em_acceleration = em_acceleration
+        self.initialization = initialization
+        self.initialization_feature_weight = initialization_feature_weight
+        self.min_variance = min_variance
+        self.min_topic_proportion = min_topic_proportion
+        self.merge_distance = merge_distance
+        self.max_topics_per_point = max_topics_per_point
+        self.min_responsibility = min_responsibility
+        self.spatial_tolerance = spatial_tolerance
+        self.memory_budget = memory_budget
+        self.dtype = np.dtype(dtype)
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_every = checkpoint_every
+        self.checkpoint_seconds = checkpoint_seconds
 
         self.topic_centers = initial_topic_centers  # k x 2
         self.topic_covar = initial_topic_covar  # k x 2 x2
@@ -83,11 +199,298 @@ class Model:
             self.h_array_history = []
             self.phi_history = []
             self.eta_penalty_history = []
+            self.em_steps_history = []
 
         self.latest_statistics = None
         self.venue_ids = None
 
-    def fit(self, train_data):
+        # Number of EM iterations (passes for stochastic EM) run by the current training, and whether it converged
+        self.num_iterations = 0
+        self.converged = False
+
+        # Precision matrices and normalizers of the topic Gaussians, cached for the current centers and covariances
+        self.geo_factors = None
+
+        # Arrays reused across the iterations of a full-batch EM run, only set while it runs
+        self.workspace = None
+
+        # Coordinates of the venues sampled from the shards by fit_sharded, collapsed topics are re-seeded from them
+        self.shard_coordinates = None
+
+        # Iteration and time of the last checkpoint
+        self.checkpoint_iteration = 0
+        self.checkpoint_time = None
+
+    def __setstate__(self, state):
+        """
+        Unpickles a model. Models pickled before an option or attribute existed get the value that behaves as they
+        did, so that they can be used and trained further.
+        """
+        state = dict(state)
+        for name, value in [("eta_solver", "cg"), ("eta_n_jobs", 1), ("eta_backend", "threading"),
+                            ("feature_n_jobs", 1), ("random_state", None), ("em_acceleration", False),
+                            ("initialization", "random"), ("initialization_feature_weight", 0.0),
+                            ("min_variance", 0.0), ("min_topic_proportion", 0.0), ("merge_distance", 0.0),
+                            ("max_topics_per_point", None), ("min_responsibility", 0.0), ("spatial_tolerance", None),
+                            ("memory_budget", None), ("dtype", np.dtype(np.float64)), ("checkpoint_path", None),
+                            ("checkpoint_every", None), ("checkpoint_seconds", None), ("num_iterations", 0),
+                            ("converged", False), ("geo_factors", None), ("workspace", None),
+                            ("shard_coordinates", None), ("checkpoint_iteration", 0), ("checkpoint_time", None),
+                            ("batch_size", None), ("learning_rate_offset", 1.0), ("learning_rate_decay", 0.7),
+                            ("stochastic_step", 0), ("running_statistics", None)]:
+            state.setdefault(name, value)
+        if state.get("track_params"):
+            state.setdefault("em_steps_history", [])
+
+        self.__dict__.update(state)
+
+    def fit(self, train_data, batch_size=None, learning_rate_offset=1.0, learning_rate_decay=0.7,
+            num_iterations=None):
+        """
+        Trains the model on the given data with expectation maximization.
+
+        :param train_data: a dictionary containing coordinates and sparse N x V_F matrices for features
+        :param batch_size: if given, runs stochastic EM on mini-batches of that many points instead of full-batch EM.
+        Global parameters are then updated from running sufficient statistics and phi is never stored in full, so
+        max_iterations counts passes over the data
+        :param learning_rate_offset: offset tau of the stochastic EM step sizes (step + tau) ^ -kappa
+        :param learning_rate_decay: decay kappa of the stochastic EM step sizes, in (0.5, 1]
+        :param num_iterations: if given, stops after that many iterations, training can then go on with resume
+        """
+        self.__reset_training(train_data, batch_size, learning_rate_offset, learning_rate_decay)
+        self.__initialize_parameters(train_data)
+
+        # We are ready, run EM
+        self.__run(train_data, num_iterations)
+
+    def partial_fit(self, train_data, unigrams=None, batch_size=None, learning_rate_offset=1.0,
+                    learning_rate_decay=0.7, num_iterations=None):
+        """
+        Continues training from the current parameters, e.g. of a model loaded with io.load_model, on new or
+        refreshed data.
+
+        :param train_data: a dictionary containing coordinates and sparse N x V_F matrices for features. Coordinates
+        must be standardized like the ones the model was trained on, see rescale_regions
+        :param unigrams: vocabulary per feature the model was trained on, as saved by io.save_model. If given, eta
+        arrays are remapped to the vocabulary of train_data and new unigrams start without deviation from the overall
+        frequencies. If not given, the vocabularies must be the same.
+        :param batch_size: see fit
+        :param learning_rate_offset: see fit
+        :param learning_rate_decay: see fit
+        :param num_iterations: see fit
+        """
+        self.__reset_training(train_data, batch_size, learning_rate_offset, learning_rate_decay)
+
+        self.geo_factors = self.compute_geo_factors(self.topic_centers, self.topic_covar)
+
+        self.__initialize_unigram_parameters(train_data, unigrams)
+
+        self.__run(train_data, num_iterations)
+
+    def resume(self, train_data, num_iterations=None):
+        """
+        Runs more EM iterations from where fit, partial_fit or the last resume stopped, with the same options. Training
+        stops once the model has converged or has run max_iterations iterations in total.
+
+        :param train_data: the data the model is being trained on
+        :param num_iterations: maximum number of iterations to run, all the remaining ones if not given
+        """
+        self.__run(train_data, num_iterations)
+
+    def fit_sharded(self, transport, num_iterations=None, sample_size=_SHARD_SAMPLE_SIZE):
+        """
+        Trains the model with full-batch EM on data split into disjoint shards, each held by a worker, see
+        model.sharded. In every iteration the workers run the E-step of their shard and send back its sufficient
+        statistics and likelihood terms. The model adds them up and runs the M-step, so phi and the feature matrices
+        never come together in one process, and phi is not stored by the model.
+
+        :param transport: sharded.ProcessTransport or SocketTransport reaching the workers
+        :param num_iterations: if given, stops after that many iterations, training can then go on with
+        resume_sharded
+        :param sample_size: number of venues drawn from the shards, in proportion to their sizes, which the
+        initialization runs on and collapsed topics are re-seeded from
+        """
+        summaries = list(transport.map("summary", [()] * transport.num_shards))
+        num_points = sum(summary.num_points for summary in summaries)
+
+        random_state = self.__get_random_state()
+        seeds = random_state.integers(2 ** 31, size=len(summaries)) if hasattr(random_state, "integers") \
+            else random_state.randint(2 ** 31, size=len(summaries))
+        sample = self.__concatenate_samples(transport.map(
+            "sample", [(int(np.ceil(sample_size * float(summary.num_points) / num_points)), seed)
+                       for summary, seed in zip(summaries, seeds)]))
+
+        # the unigram frequencies are those of all shards
+        sample["counts"] = dict((feature, np.sum([summary.counts[feature] for summary in summaries], axis=0))
+                                for feature in utils.features_of(sample))
+        sample["venue_ids"] = None
+
+        self.__reset_training(sample, None, 1.0, 0.7)
+        self.num_points = num_points
+        self.phi = None
+        self.shard_coordinates = sample["coordinates"]
+
+        self.__initialize_parameters(sample)
+
+        self.resume_sharded(transport, num_iterations)
+
+    def resume_sharded(self, transport, num_iterations=None):
+        """
+        Runs more EM iterations from where fit_sharded or the last resume_sharded stopped, see resume.
+
+        :param transport: reaching workers that hold the same shards as when training started
+        """
+        if self.is_trained():
+            return
+
+        remaining_iterations = self.max_iterations - self.num_iterations
+        if num_iterations is not None:
+            remaining_iterations = min(num_iterations, remaining_iterations)
+
+        self.__start_checkpoints()
+        self.__run_sharded_EM(transport, remaining_iterations)
+        self.__checkpoint(force=True)
+
+    @staticmethod
+    def fit_restarts(models, train_data, num_iterations=None):
+        """
+        Trains several restarts of full-batch EM on the same data together. The topics of all restarts are stacked
+        into R k x N arrays, so that their log-likelihood terms are a single product with every sparse feature matrix
+        and a single evaluation of all the Gaussians, and so are the expected unigram counts of their M-steps. Every
+        restart keeps its own parameters, random state and convergence, and is trained in place.
+
+        em_acceleration is not used, the restarts run plain EM steps.
+
+        :param models: models with the same data-related options (dtype, spatial_tolerance, memory_budget) that are
+        trained with fit from their own initialization
+        :param num_iterations: if given, every restart stops after that many iterations
+        :return: the model with the highest likelihood
+        """
+        for model in models:
+            model.fit(train_data, num_iterations=0)
+
+        for model in models:
+            model.__start_checkpoints()
+
+        Model.__run_restarts(models, train_data, num_iterations)
+
+        for model in models:
+            model.__checkpoint(force=True)
+
+        return max(models, key=lambda model: model.latest_statistics.likelihood)
+
+    def is_trained(self):
+        """
+        :return: True if EM has converged or used up its max_iterations, i.e. resume would not change the model
+        """
+        return self.converged or self.num_iterations >= self.max_iterations
+
+    def warm_start(self, model):
+        """
+        Copies the parameters of a trained model, so that partial_fit continues from them with the options of this
+        model. If the model has fewer topics, its topics with the largest mass are split until there are num_topics.
+
+        :param model: trained Model with at most as many topics
+        """
+        if model.num_topics > self.num_topics:
+            raise ValueError("Cannot warm start {0} topics from a model with {1} topics".format(
+                self.num_topics, model.num_topics))
+
+        self.theta = np.copy(model.theta)
+        self.topic_centers = np.copy(model.topic_centers)
+        self.topic_covar = np.copy(model.topic_covar)
+        self.fixed_regions = model.fixed_regions
+
+        self.m_arrays = dict((feature, np.copy(m_array)) for feature, m_array in model.m_arrays.items())
+        self.h_arrays = dict((feature, np.copy(h_array)) for feature, h_array in model.h_arrays.items())
+        self.beta_arrays = dict((feature, np.copy(beta_array)) for feature, beta_array in model.beta_arrays.items())
+
+        for _ in range(self.num_topics - model.num_topics):
+            self.__split_topic(np.argmax(self.theta))
+
+    def __split_topic(self, topic):
+        """
+        Splits a topic in two halves, which share its proportion, covariance and eta arrays. Their centers are moved
+        apart along a random direction drawn from its Gaussian, EM then separates them.
+
+        :param topic: index of the topic to split, the second half is appended as the last topic
+        """
+        offset = 0.5 * self.__get_random_state().multivariate_normal(np.zeros(2), self.topic_covar[topic])
+
+        theta = np.append(self.theta, self.theta[0, topic])
+        theta[topic] /= 2.0
+        theta[-1] /= 2.0
+        self.theta = np.reshape(theta, (1, theta.shape[0]))  # 1 x k
+
+        self.topic_centers = np.vstack([self.topic_centers, self.topic_centers[topic] + offset])  # k x 2
+        self.topic_centers[topic] -= offset
+        self.topic_covar = np.concatenate([self.topic_covar, self.topic_covar[topic:topic + 1]])  # k x 2 x 2
+
+        for feature in self.h_arrays.keys():
+            self.h_arrays[feature] = np.vstack([self.h_arrays[feature], self.h_arrays[feature][topic]])  # k x V
+            self.beta_arrays[feature] = np.vstack([self.beta_arrays[feature], self.beta_arrays[feature][topic]])
+
+    def rescale_regions(self, previous_scaler, scaler):
+        """
+        Expresses the topic regions, learned on coordinates standardized with previous_scaler, in coordinates
+        standardized with scaler. Every data load fits its own StandardScaler, so this is needed before continuing
+        training on a refreshed data set.
+        """
+        ratio = previous_scaler.scale_ / scaler.scale_  # 2
+
+        self.topic_centers = (self.topic_centers * previous_scaler.scale_ + previous_scaler.mean_ - scaler.mean_) \
+                             / scaler.scale_
+        self.topic_covar = self.topic_covar * np.outer(ratio, ratio)
+        self.geo_factors = None
+
+    def __initialize_parameters(self, train_data):
+        """
+        Initializes the parameters that are not user-supplied or warm-started, see initialization.
+        """
+        # MODEL PARAMETER INITIALIZATION =======================
+        # Initialize geographical parameters
+        labels = None
+        if self.topic_centers is None and self.topic_covar is None and self.initialization == "kmeans":
+            labels = self.__kmeans_regions(train_data)
+
+        if self.topic_centers is None:
+            self.topic_centers = self.__random_centers_from_data(train_data["coordinates"])
+
+        if self.topic_covar is None:
+            self.topic_covar = self.__random_covar()
+
+        self.geo_factors = self.compute_geo_factors(self.topic_centers, self.topic_covar)
+
+        # Proportion of topics: 1 x k
+        self.theta = np.reshape(np.array(self.num_topics * [1. / self.num_topics]), (1, self.num_topics))
+
+        # Unigram frequencies and deviations
+        self.m_arrays = {}
+        self.h_arrays = {}
+        self.beta_arrays = {}
+        self.__initialize_unigram_parameters(train_data)
+
+        if labels is not None:
+            num_points = train_data["coordinates"].shape[0]
+
+            # M-step from the hard assignments of k-means: k x N
+            assignments = sparse.csr_matrix((np.ones(num_points), (labels, np.arange(num_points))),
+                                            shape=(self.num_topics, num_points))
+
+            self.theta = self.__update_theta(np.asarray(assignments.sum(axis=1)) + 1.0)  # k x 1 counts
+            self.h_arrays, self.beta_arrays = self.__update_features(
+                train_data, None, dict((feature, (assignments * train_data[feature]).toarray())
+                                       for feature in self.h_arrays.keys()))
+
+        # Per topic & unigram alpha and beta parameters: k x V
+        self.a_gammas = copy(self.h_arrays)
+
+        for feature in self.a_gammas.keys():
+            self.a_gammas[feature] = np.abs(self.a_gammas[feature])
+
+        self.b_gammas = np.copy(self.a_gammas)
+
+    def __reset_training(self, train_data, batch_size, learning_rate_offset, learning_rate_decay):
         # Reset tracking
         if self.track_params:
             self.likelihood_history = []
@@ -101,102 +504,225 @@ class Model:
             self.h_array_history = []
             self.phi_history = []
             self.eta_penalty_history = []
+            self.em_steps_history = []
 
         self.latest_statistics = Statistics(-np.infty, -np.infty, -np.infty, -np.infty, -np.infty, -np.infty, -np.infty,
                                             [], [], [])
 
-        # MODEL PARAMETER INITIALIZATION =======================
         self.num_points = train_data["coordinates"].shape[0]
         self.venue_ids = train_data['venue_ids']
 
-        # Initialize geographical parameters
-        if self.topic_centers is None:
-            self.topic_centers = self.__random_centers_from_data(train_data["coordinates"])
-
-        if self.topic_covar is None:
-            self.topic_covar = self.__random_covar()
-
-        # Proportion of topics: 1 x k
-        self.theta = np.reshape(np.array(self.num_topics * [1. / self.num_topics]), (1, self.num_topics))
-
-        # Topic proportion per document: k x N
-        self.phi = np.zeros((self.num_topics, self.num_points))
+        # EM progress and options, kept so that training can be resumed
+        self.num_iterations = 0
+        self.converged = False
+        self.batch_size = batch_size
+        self.learning_rate_offset = learning_rate_offset
+        self.learning_rate_decay = learning_rate_decay
+
+        # Stochastic EM state
+        self.running_statistics = None
+        self.stochastic_step = 0
+
+        # Topic proportion per document: k x N, not stored by stochastic EM
+        self.phi = None
+        if batch_size is None:
+            self.phi = sparse.csr_matrix((self.num_topics, self.num_points)) if self.__truncates_phi() \
+                else np.zeros((self.num_topics, self.num_points))
         # self.phi = np.reshape(np.array(self.num_topics * [self.num_points * [1. / self.num_points]]).T,
         #                      (self.num_points, self.num_topics))
 
-        # Unigram frequencies and deviations
-        features = (feature for feature in train_data.keys()
-                    if feature not in ["coordinates", "counts", "unigrams", 'venue_ids'])
+    def __initialize_unigram_parameters(self, train_data, unigrams=None):
+        """
+        Sets the unigram frequencies from the counts of train_data and keeps the deviations of the features that are
+        already in h_arrays, remapped from the unigrams they were learned on. Deviations of new features and unigrams
+        start from zero.
+        """
+        features = utils.features_of(train_data)
 
         for feature in features:
             num_unigrams = len(train_data["unigrams"][feature])
 
             self.m_arrays[feature] = np.log([i + 1 for i in train_data["counts"][feature]]).reshape(
                 (1, num_unigrams))  # 1 x V
-            self.h_arrays[feature] = np.zeros((self.num_topics, num_unigrams))  # k x V
-            # self.h_arrays[feature] = np.random.rand(self.num_topics, num_unigrams) - 0.2
 
+            h_array = np.zeros((self.num_topics, num_unigrams))  # k x V
+            # h_array = np.random.rand(self.num_topics, num_unigrams) - 0.2
+
+            if feature in self.h_arrays and unigrams is not None:
+                previous_ids = dict((w, i) for i, w in enumerate(unigrams[feature]))
+                kept = [(i, previous_ids[w]) for i, w in enumerate(train_data["unigrams"][feature])
+                        if w in previous_ids]
+
+                if kept:
+                    new_ids, old_ids = zip(*kept)
+                    h_array[:, list(new_ids)] = self.h_arrays[feature][:, list(old_ids)]
+            elif feature in self.h_arrays:
+                if self.h_arrays[feature].shape != h_array.shape:
+                    raise ValueError("Vocabulary of {0} changed, the unigrams the model was trained on are needed "
+                                     "to remap it".format(feature))
+
+                h_array = self.h_arrays[feature]
+
+            self.h_arrays[feature] = h_array
             self.beta_arrays[feature] = \
-                self.get_topic_unigram(self.m_arrays[feature], self.h_arrays[feature])  # k x V
+                self.get_topic_unigram(self.m_arrays[feature], self.h_arrays[feature], self.dtype)  # k x V
 
-        # Per topic & unigram alpha and beta parameters: k x V
-        self.a_gammas = copy(self.h_arrays)
+        # Drop features that are not in the data anymore
+        for feature in set(self.h_arrays.keys()) - set(features):
+            del self.m_arrays[feature]
+            del self.h_arrays[feature]
+            del self.beta_arrays[feature]
 
-        for feature in self.a_gammas.keys():
-            self.a_gammas[feature] = np.abs(self.a_gammas[feature])
+    def __run(self, train_data, num_iterations):
+        if self.is_trained():
+            return
 
-        self.b_gammas = np.copy(self.a_gammas)
+        remaining_iterations = self.max_iterations - self.num_iterations
+        if num_iterations is not None:
+            remaining_iterations = min(num_iterations, remaining_iterations)
+        if remaining_iterations <= 0:
+            return
 
-        # We are ready, run EM
-        self.__run_EM(train_data)
+        self.__start_checkpoints()
 
-    def predict_log_probs(self, test_data):
-        num_points = test_data["coordinates"].shape[0]
-        topic_log_prob_vector = np.zeros((self.num_topics, num_points))
-        # topic_prob_vector = np.ones((self.num_topics, num_points))
+        if self.batch_size is None:
+            self.__run_EM(train_data, remaining_iterations)
+        else:
+            self.__run_stochastic_EM(train_data, remaining_iterations)
 
-        for z in range(self.num_topics):
-            try:
-                rv = stats.multivariate_normal(mean=self.topic_centers[z, :],
-                                               cov=self.topic_covar[z, :, :], allow_singular=True)
-                loc_log_prob = rv.logpdf(test_data["coordinates"]).reshape((num_points, 1))  # Nx1
-                # loc_prob = rv.pdf(test_data["coordinates"]).reshape((num_points, 1))  # Nx1
-
-            except:
-                print("Error while computing geo log probabilities for test, dumping data.", "\n",
-                      self.topic_centers[z, :], "\n", self.topic_covar[z, :, :], file=sys.stderr)
-                traceback.print_stack(file=sys.stderr)
-                sys.exit(1)
-
-            feature_log_prob = np.zeros((num_points, 1))
-            # feature_prob = np.ones((num_points, 1))
-            for feature in self.beta_arrays.keys():
-                beta = self.beta_arrays[feature][z]
-                num_words = beta.shape[0]
-                feature_log_prob += test_data[feature] * np.log(beta.reshape((num_words, 1)))  # (NxV * Vx1) = Nx1
-                # feature_prob *= np.prod(np.power(beta.reshape((num_words, 1)).T, test_data[feature].todense()), axis=1)
-
-            topic_log_prob_vector[z] = (loc_log_prob +
-                                        feature_log_prob +
-                                        np.tile(np.log(self.theta[0, z]), (num_points, 1))).flatten()
-            # topic_prob_vector[z] = np.multiply(np.multiply(loc_prob, feature_prob),
-            #                                    np.tile(self.theta[0, z], (num_points, 1))).flatten()
-
-        # print("direct")
-        # print(np.sum(np.log(np.sum(topic_prob_vector, axis=0))))
-        return np.sum(utils.log_sum(topic_log_prob_vector, axis=0))
+        self.__checkpoint(force=True)
+
+    def save_checkpoint(self, path):
+        """
+        Saves the state of training: the parameters, the EM progress and options, the random state (the global one of
+        numpy if the model has no random_state) and the latest statistics. phi, the beta arrays and the other arrays
+        that are recomputed from the parameters are left out, so that the file stays small. It is replaced atomically,
+        a run that dies while saving keeps its last checkpoint.
+
+        :param path: file to write
+        """
+        checkpoint = copy(self)
+        checkpoint.phi = None
+        checkpoint.beta_arrays = {}
+        checkpoint.a_gammas = {}
+        checkpoint.b_gammas = {}
+        checkpoint.geo_factors = None
+        checkpoint.workspace = None
+        checkpoint.latest_statistics = self.latest_statistics._replace(phi=None)
+        if self.track_params:
+            # the history would keep the phi of every iteration
+            checkpoint.phi_history = []
+        if self.random_state is None:
+            checkpoint.global_random_state = np.random.get_state()
+
+        with open(path + ".tmp", "wb") as checkpoint_file:
+            pickle.dump(checkpoint, checkpoint_file, pickle.HIGHEST_PROTOCOL)
+        os.replace(path + ".tmp", path)
+
+    @staticmethod
+    def load_checkpoint(path):
+        """
+        Loads a model saved with save_checkpoint, training goes on with resume (resume_sharded if it was trained with
+        fit_sharded) on the same data. If the model has no random_state, the global random state of numpy is set back
+        to that of the checkpoint.
+
+        :param path: file written by save_checkpoint
+        :return: the model, with phi recomputed by the next iteration
+        """
+        with open(path, "rb") as checkpoint_file:
+            model = pickle.load(checkpoint_file)
+
+        if hasattr(model, "global_random_state"):
+            np.random.set_state(model.global_random_state)
+            del model.global_random_state
+
+        model.beta_arrays = dict((feature, model.get_topic_unigram(model.m_arrays[feature], h_array, model.dtype))
+                                 for feature, h_array in model.h_arrays.items())
+        model.a_gammas = dict((feature, np.abs(h_array)) for feature, h_array in model.h_arrays.items())
+        model.b_gammas = np.copy(model.a_gammas)
+
+        return model
+
+    def __start_checkpoints(self):
+        # the time between checkpoints counts from the start of every training call
+        self.checkpoint_iteration = self.num_iterations
+        self.checkpoint_time = time.monotonic()
+
+    def __checkpoint(self, force=False):
+        """
+        Saves a checkpoint to checkpoint_path if one is due after checkpoint_every iterations or checkpoint_seconds,
+        or if forced.
+        """
+        path = self.checkpoint_path
+        if path is None:
+            return
+
+        every = self.checkpoint_every
+        seconds = self.checkpoint_seconds
+
+        if force and self.num_iterations == self.checkpoint_iteration and not self.converged:
+            # nothing changed since the last checkpoint, or since training started
+            return
+
+        if not force and (every is not None or seconds is not None):
+            due_iterations = every is not None and self.num_iterations - self.checkpoint_iteration >= every
+            due_time = seconds is not None and time.monotonic() - self.checkpoint_time >= seconds
+            if not due_iterations and not due_time:
+                return
+
+        self.save_checkpoint(path)
+        self.checkpoint_iteration = self.num_iterations
+        self.checkpoint_time = time.monotonic()
+
+    def predict_log_probs(self, test_data, spatial_tolerance=None):
+        """
+        :param spatial_tolerance: if given, only the topics of every point where the topic density is at least that
+        times its peak are summed over, see compute_sparse_log_terms
+        :return: log-likelihood of the test data
+        """
+        if spatial_tolerance is not None:
+            log_terms = self.compute_sparse_log_terms(test_data, self.beta_arrays, self.get_geo_factors(),
+                                                      spatial_tolerance)
+            topic_log_probs = log_terms.feature_log_likelihood.copy()
+            topic_log_probs.data += log_terms.location_log_likelihood.data
+            topic_log_probs.data += np.log(self.theta[0, self.__sparse_topics(topic_log_probs)])
+
+            return np.sum(utils.sparse_log_sum(topic_log_probs.data, topic_log_probs.indices, topic_log_probs.shape[1]))
+
+        geo_factors = self.get_geo_factors()
+        log_probs = 0.0
+
+        # the test venues are independent, only a chunk of their k x N terms is needed at once
+        for chunk in utils.chunks(test_data["coordinates"].shape[0], self.__chunk_size()):
+            log_terms = self.compute_log_terms(self.__subset(test_data, chunk, self.beta_arrays.keys()),
+                                               self.beta_arrays, geo_factors)
+
+            # k x chunk
+            topic_log_prob_vector = log_terms.feature_log_likelihood
+            topic_log_prob_vector += log_terms.location_log_likelihood
+            topic_log_prob_vector += np.log(self.theta.T)  # (1 x k)'
+
+            log_probs += np.sum(utils.log_sum(topic_log_prob_vector, axis=0))
+
+        return log_probs
 
     def predict_log_probs_variational(self, test_data):
-        data_phi = self.__update_phi(test_data, self.beta_arrays, self.theta, self.topic_centers, self.topic_covar)
+        chunk_size = self.__chunk_size()
+        log_terms = self.compute_log_terms(test_data, self.beta_arrays, self.get_geo_factors(), chunk_size=chunk_size)
+        data_phi = self.__update_phi(log_terms, self.theta, chunk_size)
         likelihood = self.compute_likelihood(test_data, self.topic_centers, self.topic_covar,
-                                             self.theta, data_phi, self.h_arrays, self.beta_arrays, self.Lambda)
+                                             self.theta, data_phi, self.h_arrays, self.beta_arrays, self.Lambda,
+                                             log_terms=log_terms, chunk_size=chunk_size)
 
         return likelihood.likelihood + 2 * likelihood.sigma_likelihood - likelihood.eta_penalty
 
     def predict_log_probs_without_geo(self, test_data):
-        data_phi = self.__update_phi(test_data, self.beta_arrays, self.theta, self.topic_centers, self.topic_covar)
+        chunk_size = self.__chunk_size()
+        log_terms = self.compute_log_terms(test_data, self.beta_arrays, self.get_geo_factors(), chunk_size=chunk_size)
+        data_phi = self.__update_phi(log_terms, self.theta, chunk_size)
         likelihood = self.compute_likelihood(test_data, self.topic_centers, self.topic_covar,
-                                             self.theta, data_phi, self.h_arrays, self.beta_arrays, self.Lambda)
+                                             self.theta, data_phi, self.h_arrays, self.beta_arrays, self.Lambda,
+                                             log_terms=log_terms, chunk_size=chunk_size)
 
         return likelihood.likelihood + 2 * likelihood.sigma_likelihood \
                - likelihood.eta_penalty - likelihood.location_likelihood, data_phi
@@ -216,6 +742,23 @@ class Model:
         else:
             return None  # We don't have anything to return
 
+    def get_geo_factors(self):
+        """
+        Returns the cached Gaussian factors for the current topic centers and covariances, recomputing them if the
+        geographical parameters changed since they were cached.
+        """
+        geo_factors = self.geo_factors
+
+        if geo_factors is None or geo_factors.topic_centers is not self.topic_centers \
+                or geo_factors.topic_covar is not self.topic_covar:
+            geo_factors = self.compute_geo_factors(self.topic_centers, self.topic_covar)
+            self.geo_factors = geo_factors
+
+        return geo_factors
+
+    def __get_random_state(self):
+        return np.random if self.random_state is None else self.random_state
+
     def __random_centers_from_data(self, coordinates):
         """
         Creates a random geographical center per each topic, distributed around the mean of given data.
@@ -226,17 +769,58 @@ class Model:
         data_covar = np.cov(coordinates, rowvar=0)
 
         topic_centers = np.array(
-            [np.random.multivariate_normal(mean=data_means, cov=data_covar) for i in range(self.num_topics)])
+            [self.__get_random_state().multivariate_normal(mean=data_means, cov=data_covar)
+             for i in range(self.num_topics)])
 
         return topic_centers
 
+    def __kmeans_regions(self, train_data):
+        """
+        Sets the topic centers and covariances from k-means clusters of the data, seeded with k-means++ and refined
+        with a few mini-batch iterations. Clusters with fewer than three points get the data covariance divided by k.
+
+        :param train_data: a dictionary containing coordinates and sparse N x V_F matrices for features
+        :return: cluster of every point (N,)
+        """
+        coordinates = train_data["coordinates"]
+        data_covar = np.cov(coordinates, rowvar=0)
+
+        feature_weight = self.initialization_feature_weight
+        points = coordinates
+        if feature_weight > 0:
+            features = utils.features_of(train_data)
+            points = sparse.hstack([sparse.csr_matrix(coordinates)] +
+                                   [feature_weight * normalize(train_data[feature]) for feature in features],
+                                   format="csr")
+
+        random_state = self.__get_random_state()
+        seed = random_state.integers(2 ** 31) if hasattr(random_state, "integers") else random_state.randint(2 ** 31)
+
+        kmeans = MiniBatchKMeans(n_clusters=self.num_topics, init="k-means++", n_init=1,
+                                 batch_size=_KMEANS_BATCH_SIZE, max_iter=_KMEANS_ITERATIONS, random_state=seed)
+        labels = kmeans.fit_predict(points)
+
+        self.topic_centers = np.array(kmeans.cluster_centers_[:, :2])  # k x 2
+        self.topic_covar = np.tile(data_covar / self.num_topics, (self.num_topics, 1, 1))  # k x 2 x 2
+
+        # keeps clusters of venues at the same location from having singular covariances
+        regularization = 1e-3 * np.diag(np.diag(data_covar))
+
+        for z in range(self.num_topics):
+            members = coordinates[labels == z]
+            if members.shape[0] > 2:
+                self.topic_centers[z] = members.mean(axis=0)
+                self.topic_covar[z] = np.cov(members, rowvar=0) + regularization
+
+        return labels
+
     def __random_covar(self):
         """
         Creates a random variance-covariance matrix per each topic.
         :return: randomly initialized covariances (k x 2 x 2)
         """
 
-        topic_covar = (np.random.rand(self.num_topics, 2, 2) * 2)
+        topic_covar = (self.__get_random_state().random((self.num_topics, 2, 2)) * 2)
 
         # Set the covariance entries to 0
         for z in range(self.num_topics):
@@ -249,160 +833,382 @@ class Model:
 
         return topic_covar
 
-    @staticmethod
-    def __update_phi(data, beta_arrays, theta, topic_centers, topic_covar):
+    def __log_terms(self, data, beta_arrays, geo_factors, location_log_likelihood=None):
         """
-        :param data: a dictionary containing coordinates and sparse N x V_F matrices for features
-        :param beta_arrays: F x k x V
-        :param theta: 1 x k
-        :param topic_centers: k x 2
-        :param topic_covar: k x 2 x 2
+        compute_log_terms, or compute_sparse_log_terms if the model has a spatial_tolerance.
         """
+        if self.spatial_tolerance is None:
+            shape = (len(geo_factors.log_norm), data["coordinates"].shape[0])
+            out = LogLikelihoodTerms(self.__empty(shape),
+                                     self.__empty(shape) if location_log_likelihood is None else None)
 
-        k, _ = topic_centers.shape
-        N, _ = data["coordinates"].shape
+            return self.compute_log_terms(data, beta_arrays, geo_factors, location_log_likelihood, self.__chunk_size(),
+                                          out)
 
-        G = np.zeros((k, N))
-        Z = np.zeros((k, N))
+        return self.compute_sparse_log_terms(data, beta_arrays, geo_factors, self.spatial_tolerance,
+                                             location_log_likelihood)
 
-        # Compute geographical probabilities
-        for z in range(k):
-            # setup distribution variable
-            rv = stats.multivariate_normal(mean=topic_centers[z, :],
-                                           cov=topic_covar[z, :, :], allow_singular=True)
-
-            log_probabilities = rv.logpdf(data["coordinates"])
-            G[z, :] = log_probabilities
-
-            # TODO: @MM, I think we can move this out of the loop, no? There can be a minor performance increase. - Emre
-            Z[z, :] = np.log(theta[0, z])
+    def __chunk_size(self, num_topics=None):
+        """
+        :param num_topics: number of rows of the temporaries, the number of topics of the model if not given
+        :return: number of venues per chunk whose k x chunk temporaries fit in memory_budget, None if unbounded
+        """
+        if self.memory_budget is None:
+            return None
 
-        # Compute new phi
-        # TODO: @MM, please check this. - Emre
-        F = np.zeros((k, N))
+        if num_topics is None:
+            num_topics = self.num_topics
 
-        for feature in beta_arrays.keys():
-            # (k x V) x (N x V)' + k x N
-            F += np.log(beta_arrays[feature]) * data[feature].transpose()
+        return max(1, int(self.memory_budget // (_CHUNK_TEMPORARIES * num_topics * np.dtype(float).itemsize)))
 
-        F += G + Z
+    def __empty(self, shape):
+        """
+        :return: an array of that shape with undefined contents, from the workspace while full-batch EM runs
+        """
+        return np.empty(shape, self.dtype) if self.workspace is None else self.workspace.empty(shape, self.dtype)
 
-        S = utils.log_sum(F, axis=0)  # 1 x N
+    def __release(self, *arrays):
+        """
+        Hands arrays that are not used anymore back to the workspace, if full-batch EM runs.
+        """
+        if self.workspace is not None:
+            self.workspace.release(*arrays)
 
-        F = F - S
+    @staticmethod
+    def compute_sparse_log_terms(data, beta_arrays, geo_factors, tolerance, location_log_likelihood=None,
+                                 groups=None):
+        """
+        Approximate compute_log_terms, for the pairs of topics and points within the Mahalanobis radius
+        sqrt(-2 log(tolerance)) of the topic only, i.e. where the topic density is at least tolerance times its peak.
+        The pairs are found with utils.gaussian_neighbors.
+
+        :param tolerance: relative density under which a topic is not evaluated at a point, in (0, 1)
+        :param location_log_likelihood: sparse k x N geographical log probabilities to reuse with their pairs,
+        computed if not given
+        :param groups: slices of the topics of different models evaluated together, see utils.gaussian_neighbors
+        :return: LogLikelihoodTerms with sparse k x N feature and geographical log probabilities on the same pairs, and
+        the exact sum of the geographical log probabilities over all pairs
+        """
+        coordinates = data["coordinates"]
+        num_topics = len(geo_factors.log_norm)
+        num_points = coordinates.shape[0]
+
+        if location_log_likelihood is None:
+            topics, points, log_pdf = utils.gaussian_neighbors(coordinates, geo_factors,
+                                                               np.sqrt(-2.0 * np.log(tolerance)), groups=groups)
+            indptr = np.concatenate([[0], np.cumsum(np.bincount(topics, minlength=num_topics))])
+            location_log_likelihood = sparse.csr_matrix((log_pdf, points, indptr), shape=(num_topics, num_points))
+        else:
+            topics = Model.__sparse_topics(location_log_likelihood)
+            points = location_log_likelihood.indices
 
-        phi = np.exp(F)  # k x N
+        # Compute feature log probabilities of the pairs from the nonzero counts of their points
+        feature_log_likelihood = np.zeros(points.shape[0])
+        for feature, beta_array in Model.__stack(data, beta_arrays).items():
+            counts = data[feature][points].tocoo()  # P x V
+            feature_log_likelihood += np.bincount(
+                counts.row, weights=counts.data * np.log(beta_array[topics[counts.row], counts.col]),
+                minlength=points.shape[0])
 
-        return phi
+        # same pairs as the geographical log probabilities
+        feature_log_likelihood = sparse.csr_matrix((feature_log_likelihood, location_log_likelihood.indices,
+                                                    location_log_likelihood.indptr), shape=(num_topics, num_points))
 
-    # @staticmethod
-    # def __update_a_b(a_gamma, b_gamma, h_array, threshold):
-    #     psi1 = lambda x: special.polygamma(1, x)
-    #     psi2 = lambda x: special.polygamma(2, x)
-    #
-    #     change = float('inf')
-    #     h2_array = np.square(h_array)
-    #     for loop in range(_NUM_OF_LOOPS):
-    #         # update a_gamma
-    #         delta_num = (0.5 + a_gamma) * psi1(a_gamma) \
-    #                     - 0.5 * np.square(h_array) * np.power(a_gamma - 1., -2) / b_gamma
-    #         delta_den = (0.5 + a_gamma) * psi2(a_gamma) \
-    #                     + np.square(h_array) * np.power(a_gamma - 1., -3) / b_gamma
-    #         # TODO avoid divisions by zero
-    #         delta_a = delta_num / delta_den
-    #         delta_a[np.nonzero(delta_den == 0.0)] = 0.
-    #         a_gamma += delta_a
-    #         # update b_gamma
-    #         delta_b = np.square(h_array) / (a_gamma - 1.) - b_gamma
-    #         b_gamma += np.square(h_array) / (a_gamma - 1.)
-    #
-    #         change_in_a = np.max(np.abs(delta_a))
-    #         change_in_b = np.max(np.abs(delta_b))
-    #         change = np.max([change_in_a, change_in_b])
-    #
-    #         if change > threshold:
-    #             break
-    #
-    #     return a_gamma, b_gamma
+        return LogLikelihoodTerms(feature_log_likelihood, location_log_likelihood,
+                                  utils.gaussian_log_pdf_sum(coordinates, geo_factors))
 
     @staticmethod
-    def __update_theta(phi):
+    def __stack(data, arrays):
         """
-        phi: k x N
+        Per feature k x V_F arrays to multiply with the feature matrices of data. If data has a stacked layout of exactly
+        those features, see utils.stack_features, they are stacked in it under the key of the stacked matrix, so that a
+        single product replaces the products of all the features.
         """
-        theta = np.sum(phi, axis=1)
-        theta /= np.sum(theta)
-        k = phi.shape[0]
-        return np.reshape(theta, (1, k))  # 1 x k
+        columns = data.get(utils.STACKED_COLUMNS)
+        if columns is None or set(columns.keys()) != set(arrays.keys()):
+            return arrays
+
+        return {utils.STACKED_FEATURES: utils.stack_columns(arrays, columns)}
 
     @staticmethod
-    def __update_centers(phi, data_coords):
+    def __feature_products(data, phi, features):
         """
-        phi:            k x N
-        data_coords:    N x 2
+        :param phi: k x N array or sparse matrix
+        :return: dictionary of the dense k x V_F products phi * data[feature]. If data has a stacked layout of the
+        features, they are views of a single product with the stacked matrix
         """
-        sum_phi = np.sum(phi, axis=1)  # k x 1
+        columns = data.get(utils.STACKED_COLUMNS)
+        if columns is not None and all(feature in columns for feature in features):
+            product = phi * data[utils.STACKED_FEATURES]  # k x (V_1 + ... + V_F)
+            if sparse.issparse(product):
+                product = product.toarray()
+
+            return dict((feature, product[:, columns[feature]]) for feature in features)
 
-        return ((phi.dot(data_coords)).T / sum_phi).T  # (k x N * N x 2) / k x 1
+        # we don't want to transpose the sparse matrix, k x V
+        products = dict((feature, phi * data[feature]) for feature in features)
+
+        # a sparse phi gives sparse products
+        return dict((feature, product.toarray() if sparse.issparse(product) else product)
+                    for feature, product in products.items())
 
     @staticmethod
-    def __update_covar(phi, topic_centers, data_coords):
+    def __sparse_topics(matrix):
         """
-        phi:			k x N
-        data_coords:	N x 2
+        :return: topic (row) index of every stored entry of a sparse k x N CSR matrix
         """
-        k, N = phi.shape
-        data_xx = data_coords[:, 0]  # N x 1
-        data_yy = data_coords[:, 1]  # N x 1
+        return np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
 
-        x_array = np.zeros((k, N))
-        y_array = np.zeros((k, N))
+    @staticmethod
+    def compute_log_terms(data, beta_arrays, geo_factors, location_log_likelihood=None, chunk_size=None, out=None):
+        """
+        Computes the per topic log-likelihood terms of every data point, in a single pass over the sparse feature
+        matrices. They are shared by the E-step, the likelihood and prediction.
 
-        for z in range(k):
-            x_array[z] = data_xx - topic_centers[z, 0]  # N x 1 - 1
-            y_array[z] = data_yy - topic_centers[z, 1]
+        :param data: a dictionary containing coordinates and sparse N x V_F matrices for features. If it has a stacked
+        layout of the features, see utils.stack_features, the feature terms are a single product with it
+        :param beta_arrays: F x k x V
+        :param geo_factors: GeoFactors of the topic Gaussians
+        :param location_log_likelihood: k x N geographical log probabilities to reuse, computed if not given
+        :param chunk_size: if given, the terms are filled in chunks of that many points, see utils.chunks
+        :param out: LogLikelihoodTerms of k x N arrays to write the terms into, allocated if not given. The
+        geographical one is not used if location_log_likelihood is given
+        :return: LogLikelihoodTerms with the k x N feature and geographical log probabilities
+        """
+        num_points = data["coordinates"].shape[0]
+        num_topics = len(geo_factors.log_norm)
+        log_beta_arrays = Model.__stack(data, dict((feature, np.log(beta_array))
+                                                   for feature, beta_array in beta_arrays.items()))
+        dtype = np.result_type(*log_beta_arrays.values()) if log_beta_arrays else np.float64
 
-        coeff_sum = np.sum(phi, axis=1)  # 1 x k (k,)
-        coeff_sum_squared = np.power(coeff_sum, 2.0)  # 1 x k
-        coeff_sum_of_squares = np.sum(np.power(phi, 2.0), axis=1)  # 1 x k
-        coeff = coeff_sum / (coeff_sum_squared - coeff_sum_of_squares)  # 1 x k
+        # Compute feature log probabilities
+        # TODO: @MM, please check this. - Emre
+        if out is None:
+            feature_log_likelihood = np.zeros((num_topics, num_points), dtype)
+        else:
+            feature_log_likelihood = out.feature_log_likelihood
+            feature_log_likelihood.fill(0.0)
+        for chunk in utils.chunks(num_points, chunk_size):
+            block = feature_log_likelihood[:, chunk]
+            for feature, log_beta_array in log_beta_arrays.items():
+                rows = data[feature] if chunk_size is None else data[feature][chunk]
+                # ((chunk x V) x (k x V)')', added a few thousand points at a time so that the transposition stays in
+                # cache for large k
+                product = rows.dot(log_beta_array.T)
+                for part in utils.chunks(product.shape[0], _TRANSPOSE_CHUNK_SIZE):
+                    block[:, part] += product[part].T
+
+        # Compute geographical log probabilities
+        if location_log_likelihood is None:
+            if out is None:
+                location_log_likelihood = np.empty((num_topics, num_points), dtype)
+            else:
+                location_log_likelihood = out.location_log_likelihood
 
-        cov_xx = coeff * np.sum(x_array * x_array * phi, axis=1)  # k x N * k x N * k x N
-        cov_xy = coeff * np.sum(x_array * y_array * phi, axis=1)  # k x N * k x N * k x N
-        cov_yy = coeff * np.sum(y_array * y_array * phi, axis=1)  # k x N * k x N * k x N
+            for chunk in utils.chunks(num_points, chunk_size):
+                utils.gaussian_log_pdf(data["coordinates"][chunk], geo_factors, out=location_log_likelihood[:, chunk])
 
-        topic_covar = np.zeros((k, 2, 2))
-        for i in range(k):
-            topic_covar[i, :, :] = np.array([cov_xx[i], cov_xy[i], cov_xy[i], cov_yy[i]]).reshape((1, 2, 2))
+        return LogLikelihoodTerms(feature_log_likelihood, location_log_likelihood)
 
-        return topic_covar
+    @staticmethod
+    def __update_phi(log_terms: LogLikelihoodTerms, theta, chunk_size=None, out=None):
+        """
+        :param log_terms: LogLikelihoodTerms of the data for the current beta arrays and topic Gaussians
+        :param theta: 1 x k
+        :param chunk_size: if given, phi is normalized in place in chunks of that many points
+        :param out: k x N array to write phi into, allocated if not given
+        """
+        # Compute new phi, k x N
+        phi = np.add(log_terms.feature_log_likelihood, log_terms.location_log_likelihood, out=out)
+        log_theta = np.log(theta.T)  # (1 x k)'
+
+        for chunk in utils.chunks(phi.shape[1], chunk_size):
+            F = phi[:, chunk]  # view of phi, k x chunk
+
+            F += log_theta
+
+            S = utils.log_sum(F, axis=0)  # 1 x chunk
+
+            F -= S
+
+            np.exp(F, out=F)
+
+        return phi
+
+    def __truncates_phi(self):
+        return self.max_topics_per_point is not None or self.min_responsibility > 0
+
+    def __responsibilities(self, log_terms: LogLikelihoodTerms, theta, out=None):
+        """
+        E-step of training: __update_phi, or its truncation to the max_topics_per_point most likely topics of every
+        point with responsibilities above min_responsibility, renormalized.
+
+        :param out: k x N array to write dense responsibilities into, allocated if not given
+        :return: phi, k x N array, or sparse k x N matrix if truncated or if the log-likelihood terms are sparse
+        """
+        if sparse.issparse(log_terms.feature_log_likelihood):
+            return self.__sparse_responsibilities(log_terms, theta)
+
+        chunk_size = self.__chunk_size()
+        k, N = log_terms.feature_log_likelihood.shape
+
+        if not self.__truncates_phi():
+            return self.__update_phi(log_terms, theta, chunk_size, self.__empty((k, N)) if out is None else out)
+
+        m = min(self.max_topics_per_point or k, k)
+        log_theta = np.log(theta.T)  # (1 x k)'
+        buffer = self.__empty((k, min(chunk_size or N, N)))
+
+        kept_responsibilities, kept_topics, kept_points = [], [], []
+        for chunk in utils.chunks(N, chunk_size):
+            F = np.add(log_terms.feature_log_likelihood[:, chunk], log_terms.location_log_likelihood[:, chunk],
+                       out=buffer[:, :chunk.stop - chunk.start])
+            F += log_theta
+            n = F.shape[1]
+
+            if m < k:
+                topics = np.argpartition(-F, m - 1, axis=0)[:m]  # m x chunk
+                F = np.take_along_axis(F, topics, axis=0)
+            else:
+                topics = np.broadcast_to(np.arange(k)[:, np.newaxis], (k, n))
+
+            F -= utils.log_sum(F, axis=0)
+            responsibilities = np.exp(F, out=F)  # m x chunk
+
+            if self.min_responsibility > 0:
+                # the most likely topic of a point is always kept
+                threshold = np.minimum(self.min_responsibility, np.max(responsibilities, axis=0))
+                responsibilities[responsibilities < threshold] = 0.0
+                responsibilities /= np.sum(responsibilities, axis=0)
+
+            kept = responsibilities > 0
+            points = np.broadcast_to(np.arange(chunk.start, chunk.stop), topics.shape)
+
+            kept_responsibilities.append(responsibilities[kept])
+            kept_topics.append(topics[kept])
+            kept_points.append(points[kept])
+
+        self.__release(buffer)
+
+        return sparse.csr_matrix((np.concatenate(kept_responsibilities),
+                                  (np.concatenate(kept_topics), np.concatenate(kept_points))), shape=(k, N),
+                                 dtype=self.dtype)
+
+    def __sparse_responsibilities(self, log_terms: LogLikelihoodTerms, theta):
+        """
+        __responsibilities over the pairs of sparse log-likelihood terms, see compute_sparse_log_terms.
+        """
+        k, N = log_terms.feature_log_likelihood.shape
+        topics = self.__sparse_topics(log_terms.feature_log_likelihood)
+        points = log_terms.feature_log_likelihood.indices
+
+        F = log_terms.feature_log_likelihood.data + log_terms.location_log_likelihood.data
+        F += np.log(theta[0, topics])
+
+        max_topics_per_point = self.max_topics_per_point
+        min_responsibility = self.min_responsibility
+
+        if max_topics_per_point is not None:
+            # rank of every pair among the pairs of its point
+            order = np.lexsort((-F, points))
+            first = np.searchsorted(points[order], points[order])
+            ranks = np.empty(F.shape[0], dtype=int)
+            ranks[order] = np.arange(F.shape[0]) - first
+
+            kept = ranks < max_topics_per_point
+            topics, points, F = topics[kept], points[kept], F[kept]
+
+        F -= utils.sparse_log_sum(F, points, N)[points]
+        responsibilities = np.exp(F, out=F)
+
+        if min_responsibility > 0:
+            # the most likely topic of a point is always kept
+            maxima = np.zeros(N)
+            np.maximum.at(maxima, points, responsibilities)
+
+            kept = responsibilities >= np.minimum(min_responsibility, maxima)[points]
+            topics, points, responsibilities = topics[kept], points[kept], responsibilities[kept]
+            responsibilities /= np.bincount(points, weights=responsibilities, minlength=N)[points]
+
+        return sparse.csr_matrix((responsibilities, (topics, points)), shape=(k, N), dtype=self.dtype)
+
+    # @staticmethod
+    # def __update_a_b(a_gamma, b_gamma, h_array, threshold):
+    #     psi1 = lambda x: special.polygamma(1, x)
+    #     psi2 = lambda x: special.polygamma(2, x)
+    #
+    #     change = float('inf')
+    #     h2_array = np.square(h_array)
+    #     for loop in range(_NUM_OF_LOOPS):
+    #         # update a_gamma
+    #         delta_num = (0.5 + a_gamma) * psi1(a_gamma) \
+    #                     - 0.5 * np.square(h_array) * np.power(a_gamma - 1., -2) / b_gamma
+    #         delta_den = (0.5 + a_gamma) * psi2(a_gamma) \
+    #                     + np.square(h_array) * np.power(a_gamma - 1., -3) / b_gamma
+    #         # TODO avoid divisions by zero
+    #         delta_a = delta_num / delta_den
+    #         delta_a[np.nonzero(delta_den == 0.0)] = 0.
+    #         a_gamma += delta_a
+    #         # update b_gamma
+    #         delta_b = np.square(h_array) / (a_gamma - 1.) - b_gamma
+    #         b_gamma += np.square(h_array) / (a_gamma - 1.)
+    #
+    #         change_in_a = np.max(np.abs(delta_a))
+    #         change_in_b = np.max(np.abs(delta_b))
+    #         change = np.max([change_in_a, change_in_b])
+    #
+    #         if change > threshold:
+    #             break
+    #
+    #     return a_gamma, b_gamma
 
     @staticmethod
-    def __update_covar2(phi, topic_centers, data_coords):
+    def __update_theta(phi):
+        """
+        phi: k x N, array or sparse matrix
         """
-        phi:            k x N
+        theta = utils.sum_rows(phi)
+        theta /= np.sum(theta)
+        k = phi.shape[0]
+        return np.reshape(theta, (1, k))  # 1 x k
+
+    def __recover_regions(self, sum_phi, theta, topic_centers, topic_covar, data_coords):
+        """
+        Floors the eigenvalues of the topic covariances at min_variance and re-seeds the topics that collapsed, i.e.
+        that have less phi mass than _MIN_TOPIC_MASS points or non-finite parameters. A collapsed topic moves to a
+        random data point, with the data covariance divided by k and an even share of theta, or a share that gets it
+        dropped if topics are pruned.
+
+        sum_phi:        k, phi mass of every topic
+        theta:          1 x k
         data_coords:    N x 2
         """
-        # New covar estimation
-        k, N = phi.shape
+        finite = np.all(np.isfinite(topic_centers), axis=1) & np.all(np.isfinite(topic_covar), axis=(1, 2))
+        collapsed = ~finite | (sum_phi < _MIN_TOPIC_MASS)
 
-        diff = np.zeros((k, N, 2))  # k x N x 2
+        if np.any(collapsed):
+            self.__log("Re-seeding collapsed topics {0}".format(np.nonzero(collapsed)[0].tolist()), 1)
 
-        for z in range(k):
-            diff[z, :, :] = data_coords - topic_centers[z]  # N x 2 - 1 x 2
+            num_collapsed = np.sum(collapsed)
+            points = self.__get_random_state().choice(data_coords.shape[0], num_collapsed, replace=False)
 
-        coeff_sum = np.sum(phi, axis=1) + 4.0  # 1 x k
+            topic_centers = np.copy(topic_centers)
+            topic_centers[collapsed] = data_coords[points]
 
-        topic_covar = np.zeros((k, 2, 2))
+            topic_covar = np.copy(topic_covar)
+            topic_covar[collapsed] = np.cov(data_coords, rowvar=0) / self.num_topics
 
-        for z in range(k):
-            phi_vec = phi[z, :].reshape((N, 1))
-            topic_covar[z, :, :] = ((phi_vec * diff[z]).T.dot(diff[z])) / coeff_sum[z]  # (N x 1 *! N x 2)' * N x 2
+            # a share below min_topic_proportion gets the topic dropped after the iteration
+            theta = np.copy(theta)
+            theta[0, collapsed] = 0.5 * self.min_topic_proportion if self.min_topic_proportion > 0 \
+                else 1.0 / self.num_topics
+            theta /= np.sum(theta)
 
-        return topic_covar
+        return theta, topic_centers, utils.floor_covariances(topic_covar, self.min_variance)
 
     @staticmethod
-    def compute_likelihood(data, topic_centers, topic_covar, theta, phi, h_arrays, beta_arrays, Lambda):
+    def compute_likelihood(data, topic_centers, topic_covar, theta, phi, h_arrays, beta_arrays, Lambda,
+                           geo_factors=None, log_terms=None, chunk_size=None):
         """
         Computes log-likelihood of the model against the data for given parameters.
 
@@ -412,51 +1218,85 @@ class Model:
         :param phi: k x N array
         :param topic_covar: z x 2 x 2 matrix containing variance-covariance matrices per topic for geographical location
         :param topic_centers: z x 2 matrix containing distribution centers per topic for geographical location
+        :param geo_factors: cached GeoFactors for topic_centers and topic_covar, computed if not given
+        :param log_terms: cached LogLikelihoodTerms of the data for beta_arrays and the topic Gaussians, computed if
+        not given
+        :param chunk_size: if given, the sums over points are computed in chunks of that many points
         :return: log likelihood according to given parameters
         """
+        if log_terms is None:
+            if geo_factors is None:
+                geo_factors = Model.compute_geo_factors(topic_centers, topic_covar)
 
-        # I think this can be made to perform better by doing one for loop over the whole data - the reason I did it in
-        # separate for loops is to track the contribution of each feature
-        num_topics, num_points = phi.shape
+            log_terms = Model.compute_log_terms(data, beta_arrays, geo_factors, chunk_size=chunk_size)
 
-        # Compute user likelihoods
-        # TODO: @MM, please check this. - Emre
-        user_likelihood = 0
-        for feature in beta_arrays.keys():
-            user_likelihood += np.sum(np.log(beta_arrays[feature]) * data[feature].transpose(copy=False) * phi)
+        bound_terms = Model.compute_bound_terms(log_terms, theta, phi, chunk_size)
 
-        # Compute location likelihoods
-        loc_likelihood = 0.0
+        return Model.statistics_from_bound_terms(bound_terms, topic_centers, topic_covar, h_arrays, Lambda, phi)
 
-        for z in range(num_topics):
-            try:
-                rv = stats.multivariate_normal(mean=topic_centers[z, :],
-                                               cov=topic_covar[z, :, :], allow_singular=True)
-                loc_likelihood += sum(phi[z, :] + rv.logpdf(data["coordinates"]))
-            except:
-                # TODO we get this very often --MM
-                print("Error while computing geo probabilities for likelihood, dumping data.", "\n",
-                      topic_centers[z, :], "\n", topic_covar[z, :, :], file=sys.stderr)
-                traceback.print_stack(file=sys.stderr)
-                sys.exit(1)
-
-        # Compute topic likelihoods ( log p(z|theta) )
-        topic_likelihood = np.sum(np.log(theta.T) * phi)  # (1 x k)' *! k x N
+    @staticmethod
+    def compute_bound_terms(log_terms: LogLikelihoodTerms, theta, phi, chunk_size=None):
+        """
+        Computes the terms of the likelihood that are sums over data points, so that they can be accumulated over
+        batches of points.
 
-        # Compute covariance likelihoods ( P(S|I) )
-        sigma_likelihood = 0.0
+        :param log_terms: LogLikelihoodTerms of the data
+        :param theta: 1 x k
+        :param phi: k x N array, or sparse matrix of truncated responsibilities
+        :param chunk_size: if given, the sums over a dense phi are accumulated in chunks of that many points
+        :return: BoundTerms
+        """
+        if sparse.issparse(phi):
+            # the products only need the nonzero responsibilities
+            user_likelihood = phi.multiply(log_terms.feature_log_likelihood).sum(dtype=np.float64)
+            topic_likelihood = phi.multiply(np.log(theta.T)).sum(dtype=np.float64)
+            phi_log_phi = np.sum(special.xlogy(phi.data, phi.data), dtype=np.float64)
+            phi_sum = phi.sum(dtype=np.float64)
+
+            # sparse log-likelihood terms come with the sum of all the geographical log probabilities
+            location_sum = log_terms.location_log_likelihood_sum
+            if location_sum is None:
+                location_sum = log_terms.location_log_likelihood.sum(dtype=np.float64)
+
+            return BoundTerms(user_likelihood, phi_sum + location_sum, topic_likelihood, phi_log_phi, phi_sum)
+
+        log_theta = np.log(theta.T)  # (1 x k)'
+
+        user_likelihood = 0.0
+        topic_likelihood = 0.0
+        phi_log_phi = 0.0
+        for chunk in utils.chunks(phi.shape[1], chunk_size):
+            phi_chunk = phi[:, chunk]  # k x chunk
+
+            # Compute user likelihoods
+            user_likelihood += np.einsum('kn,kn->', log_terms.feature_log_likelihood[:, chunk], phi_chunk,
+                                         dtype=np.float64)
+
+            # Compute topic likelihoods ( log p(z|theta) )
+            topic_likelihood += np.dot(log_theta[:, 0], np.sum(phi_chunk, axis=1, dtype=np.float64))  # (1 x k)' * k
 
-        for z in range(num_topics):
-            sigma_likelihood += np.log(np.linalg.det(topic_covar[z, :, :]))
+            # Unnormalized phi (i.e. q_d(z)) entropy terms, the limit of phi * log(phi) is zero as phi approaches zero
+            phi_log_phi += np.sum(special.xlogy(phi_chunk, phi_chunk), dtype=np.float64)
 
-        # Compute phi (i.e. q_d(z)) entropy
-        phi_entropy = -stats.entropy(phi.ravel())
-        # up to normalization (namely I think the version above is divided by
-        # N), this should be equivalent to the previous version below
-        # phi_mul = phi * np.log(phi)
-        # nan_idx = np.where(np.isnan(phi_mul))
-        # phi_mul[nan_idx] = 0.0  # Since the limit approaches zero as the probability approaches zero
-        # phi_entropy = np.sum(phi_mul)
+        # Compute location likelihoods, sums in float64 also for float32 arrays
+        phi_sum = np.sum(phi, dtype=np.float64)
+        loc_likelihood = phi_sum + np.sum(log_terms.location_log_likelihood, dtype=np.float64)
+
+        return BoundTerms(user_likelihood, loc_likelihood, topic_likelihood, phi_log_phi, phi_sum)
+
+    @staticmethod
+    def statistics_from_bound_terms(bound_terms: BoundTerms, topic_centers, topic_covar, h_arrays, Lambda, phi=None):
+        """
+        Completes the likelihood from the per point terms of all data points and the terms of the parameters.
+
+        :param bound_terms: BoundTerms summed over all data points
+        :return: Statistics
+        """
+        # Compute covariance likelihoods ( P(S|I) )
+        sigma_likelihood = np.sum(np.log(np.linalg.det(topic_covar)))
+
+        # Compute phi (i.e. q_d(z)) entropy, normalized by the number of points as scipy.stats.entropy(phi.ravel())
+        phi_entropy = bound_terms.phi_log_phi / bound_terms.phi_sum - np.log(bound_terms.phi_sum)
 
         # TODO: @MM, please check this. - Emre
         h_penalty = 0
@@ -465,18 +1305,126 @@ class Model:
             h_penalty += - Lambda * np.sum(np.abs(h_arrays[feature]))
             # h_penalty += - np.sum(np.log(np.abs(h_arrays[feature] + _EPSILON)))
 
-        likelihood = user_likelihood + loc_likelihood + topic_likelihood \
+        likelihood = bound_terms.user_likelihood + bound_terms.location_likelihood + bound_terms.topic_likelihood \
                      - 2.0 * sigma_likelihood - phi_entropy + h_penalty
 
-        return Statistics(likelihood, user_likelihood, loc_likelihood, topic_likelihood, sigma_likelihood, phi_entropy,
-                          h_penalty, topic_centers, topic_covar, phi)
+        return Statistics(likelihood, bound_terms.user_likelihood, bound_terms.location_likelihood,
+                          bound_terms.topic_likelihood, sigma_likelihood, phi_entropy, h_penalty,
+                          topic_centers, topic_covar, phi)
+
+    @staticmethod
+    def __coordinate_moments(coordinates):
+        """
+        :param coordinates: N x 2
+        :return: N x 7, 1, x, y and the outer product xx, xy, yx, yy of every point
+        """
+        N = coordinates.shape[0]
+
+        return np.column_stack([np.ones(N), coordinates,
+                                np.einsum('ni,nj->nij', coordinates, coordinates).reshape((N, 4))])
+
+    @staticmethod
+    def compute_sufficient_statistics(data, phi, features, chunk_size=None):
+        """
+        Computes the phi-weighted sufficient statistics of the M-step. They are sums over points, so that the
+        statistics of batches or of parts of the data can be added up.
+
+        :param data: a dictionary containing coordinates and sparse N x V_F matrices for features
+        :param phi: k x N array, or sparse matrix of truncated responsibilities
+        :param features: features to compute the expected unigram counts for
+        :param chunk_size: if given, a dense phi is processed in chunks of that many points
+        :return: SufficientStatistics
+        """
+        coordinates = data["coordinates"]
+        k, N = phi.shape
+
+        if sparse.issparse(phi):
+            sums = phi.dot(Model.__coordinate_moments(coordinates))  # k x N * N x 7
+            sum_phi_squared = utils.sum_rows(phi.multiply(phi))  # k
+        else:
+            if chunk_size is None and phi.dtype != np.float64:
+                # a float32 phi is accumulated in float64, one chunk at a time
+                chunk_size = _FLOAT64_CHUNK_SIZE
+
+            sums = np.zeros((k, 7))
+            sum_phi_squared = np.zeros(k)
+            for chunk in utils.chunks(N, chunk_size):
+                phi_chunk = np.asarray(phi[:, chunk], dtype=np.float64)  # k x chunk
+
+                sums += phi_chunk.dot(Model.__coordinate_moments(coordinates[chunk]))  # k x chunk * chunk x 7
+                sum_phi_squared += np.einsum('kn,kn->k', phi_chunk, phi_chunk)
+
+        # k x V, dense for the eta solvers
+        sparse_and_phi = Model.__feature_products(data, phi, features)
+
+        return SufficientStatistics(sums[:, 0], sum_phi_squared, sums[:, 1:3], sums[:, 3:].reshape((k, 2, 2)),
+                                    sparse_and_phi)
+
+    @staticmethod
+    def __blend_statistics(running, batch, weight, scale):
+        """
+        Moves running sufficient statistics towards the scaled statistics of a batch:
+        (1 - weight) * running + weight * scale * batch
+        """
+        if running is None:
+            return SufficientStatistics(*[dict((feature, scale * value) for feature, value in field.items())
+                                          if isinstance(field, dict) else scale * field for field in batch])
+
+        return SufficientStatistics(*[dict((feature, (1.0 - weight) * running_field[feature] + weight * scale * value)
+                                           for feature, value in batch_field.items())
+                                      if isinstance(batch_field, dict)
+                                      else (1.0 - weight) * running_field + weight * scale * batch_field
+                                      for running_field, batch_field in zip(running, batch)])
 
     @staticmethod
-    def get_topic_unigram(m_array, h_array):
+    def __parameters_from_statistics(statistics: SufficientStatistics):
+        """
+        M-step for theta, topic centers and covariances. The covariances are the unbiased weighted ones,
+        sum_phi / (sum_phi^2 - sum_phi_squared) * sum_n phi (x_n - mu)(x_n - mu)'.
+
+        :return: theta (1 x k), topic_centers (k x 2), topic_covar (k x 2 x 2)
+        """
+        sum_phi = statistics.sum_phi
+        k = sum_phi.shape[0]
+
+        theta = np.reshape(sum_phi / np.sum(sum_phi), (1, k))
+
+        # a topic without mass gets non-finite parameters, which __recover_regions re-seeds
+        with np.errstate(divide='ignore', invalid='ignore'):
+            topic_centers = statistics.sum_phi_coordinates / sum_phi[:, np.newaxis]  # k x 2
+
+            # sum_n phi (x_n - mu)(x_n - mu)' = sum_n phi x_n x_n' - sum_phi mu mu'
+            scatter = statistics.sum_phi_outer - sum_phi[:, np.newaxis, np.newaxis] * \
+                      np.einsum('ki,kj->kij', topic_centers, topic_centers)
+            coeff = sum_phi / (np.square(sum_phi) - statistics.sum_phi_squared)  # k
+
+            topic_covar = coeff[:, np.newaxis, np.newaxis] * scatter  # k x 2 x 2
+
+        return theta, topic_centers, topic_covar
+
+    @staticmethod
+    def compute_geo_factors(topic_centers, topic_covar):
+        """
+        Computes GeoFactors for the given topic Gaussians, raising utils.Error if one of the covariances is not
+        positive semi-definite.
+
+        :param topic_centers: k x 2
+        :param topic_covar: k x 2 x 2
+        """
+        try:
+            return utils.gaussian_factors(topic_centers, topic_covar)
+        except utils.Error:
+            # TODO we get this very often --MM
+            print("Error while computing geo probabilities, dumping data.", "\n",
+                  topic_centers, "\n", topic_covar, file=sys.stderr)
+            raise
+
+    @staticmethod
+    def get_topic_unigram(m_array, h_array, dtype=None):
         """
         m_array: 1 x V
         h_array: k x V
-        beta_array: k x V
+        beta_array: k x V, of the given dtype or that of m_array + h_array
         """
         beta_array = m_array + h_array
         norm_sum = utils.log_sum(beta_array, axis=1)
@@ -488,123 +1436,797 @@ class Model:
             sys.stderr.write("\n")
             sys.stderr.write(str(norm_sum))
             sys.stderr.write("\n")
-        return beta_array
+        return beta_array if dtype is None else beta_array.astype(dtype, copy=False)
+
+    def __run_EM(self, data, num_iterations):
+        # The k x N arrays of the states that are replaced are reused by the next iterations
+        self.workspace = Workspace()
+        try:
+            self.__run_EM_iterations(data, num_iterations)
+            self.__log("Workspace: {0} arrays allocated, {1} reused".format(self.workspace.allocations,
+                                                                         self.workspace.reuses), 2)
+        finally:
+            self.workspace = None
+
+    def __run_EM_iterations(self, data, num_iterations):
+        # Log-likelihood terms of the current parameters. They are computed once per iteration, after the M-step, and
+        # shared by the likelihood of the iteration and the E-step of the next one.
+        geo_factors = self.get_geo_factors()
+        state = EMState(self.theta, self.topic_centers, self.topic_covar, self.h_arrays, self.beta_arrays, geo_factors,
+                        self.__log_terms(data, self.beta_arrays, geo_factors), self.phi, self.latest_statistics)
+
+        last_iteration = self.num_iterations + num_iterations
+
+        while self.num_iterations < last_iteration:
+            self.__log("[k = {0}] At iteration {1}".format(self.num_topics, self.num_iterations + 1), 1)
+
+            # a SQUAREM step runs three EM steps
+            if self.em_acceleration and last_iteration - self.num_iterations >= 3:
+                u_state, em_steps = self.__squarem_step(data, state)
+            else:
+                u_state, em_steps = self.__em_step(data, state), 1
 
-    def __run_EM(self, data):
-        for em_step in range(self.max_iterations):
-            self.__log("[k = {0}] At iteration {1}".format(self.num_topics, em_step + 1), 1)
+            state = self.__register_step(data, state, u_state, em_steps)
+            if state is None:
+                break
+
+    def __register_step(self, data, state: EMState, u_state: EMState, em_steps):
+        """
+        Makes the parameters of an EM step those of the model, records its likelihood, prunes topics and checks
+        convergence.
 
-            # E-Step ==================================================================================================
-            # update phi
-            u_phi = self.__update_phi(data, self.beta_arrays, self.theta, self.topic_centers, self.topic_covar)
-            # TODO this is necessary only to compute the optimized lower bound
-            # a_gamma, b_gamma = self.__update_a_b(a_gamma, b_gamma, h_array, _EPSILON)
+        :param state: EMState the step started from
+        :param u_state: EMState of the step
+        :param em_steps: number of EM steps that u_state took
+        :return: EMState to run the next step from, None if training stops
+        """
+        if u_state.statistics is None:
+            # cannot compute likelihood
+            # TODO why? no convergence? --MM
+            self.__log("Cannot compute likelihood", 0)
 
-            # M-Step ==================================================================================================
-            # update theta
-            u_theta = self.__update_theta(u_phi)
+            # just report whatever we had from before, and do not try again on resume
+            self.__update_stats(self.latest_statistics)
+            self.converged = True
+            return None
 
-            # update location centers and variances
-            if not self.fixed_regions:
-                u_topic_centers = self.__update_centers(u_phi, data["coordinates"])
-                u_topic_covar = self.__update_covar(u_phi, u_topic_centers, data["coordinates"])
-            else:
-                u_topic_centers = self.topic_centers
-                u_topic_covar = self.topic_covar
+        dlikelihood = np.abs(u_state.statistics.likelihood - self.latest_statistics.likelihood)
+
+        # register the updates
+        self.phi = u_state.phi
+        self.theta = u_state.theta
+        if not self.fixed_regions:
+            self.topic_centers = u_state.topic_centers
+            self.topic_covar = u_state.topic_covar
+            self.geo_factors = u_state.geo_factors
+        self.h_arrays = u_state.h_arrays
+        self.beta_arrays = u_state.beta_arrays
+
+        self.num_iterations += em_steps
+        self.__update_stats(u_state.statistics)
+
+        self.__release_state(state, u_state)
+        state = u_state
+
+        if self.__prune_topics():
+            if self.workspace is not None:
+                # the arrays of the previous number of topics are not needed anymore
+                self.workspace.clear()
+
+            geo_factors = self.get_geo_factors()
+            state = EMState(self.theta, self.topic_centers, self.topic_covar, self.h_arrays, self.beta_arrays,
+                            geo_factors, self.__log_terms(data, self.beta_arrays, geo_factors), self.phi,
+                            u_state.statistics)
+
+        self.__log("EM step {0}, {1}".format(self.num_iterations, u_state.statistics[0:7]), 2)
+
+        if abs(dlikelihood / u_state.statistics.likelihood) < self.minimum_relative_change:
+            self.converged = True
+            return None
+
+        self.__checkpoint()
+
+        return state
+
+    def __release_state(self, state: EMState, u_state: EMState):
+        """
+        Hands the k x N arrays of state, which u_state replaced, back to the workspace, except those that u_state
+        still uses. phi is kept if the parameters are tracked, the history refers to it.
+        """
+        arrays = [] if state.log_terms is None else [state.log_terms.feature_log_likelihood,
+                                                    state.log_terms.location_log_likelihood]
+        if not self.track_params:
+            arrays.append(state.phi)
+
+        in_use = [u_state.phi] if u_state.log_terms is None else [u_state.phi, u_state.log_terms.feature_log_likelihood,
+                                                                   u_state.log_terms.location_log_likelihood]
+
+        self.__release(*[array for array in arrays if not any(array is used for used in in_use)])
+
+    def __em_step(self, data, state: EMState):
+        """
+        Runs one EM step from the parameters of state.
 
-            # update eta and beta
-            u_h_arrays = {}
-            u_beta_arrays = {}
-            dh = 0
+        :param state: EMState of the current parameters, with their log-likelihood terms
+        :return: EMState of the updated parameters, with the phi of the E-step and the likelihood of the step. The
+        statistics are None if the likelihood cannot be computed
+        """
+        # E-Step ======================================================================================================
+        # update phi
+        u_phi = self.__responsibilities(state.log_terms, state.theta)
+        # TODO this is necessary only to compute the optimized lower bound
+        # a_gamma, b_gamma = self.__update_a_b(a_gamma, b_gamma, h_array, _EPSILON)
+
+        # M-Step ======================================================================================================
+        # update theta, location centers and variances from one pass of sufficient statistics over phi
+        statistics = self.compute_sufficient_statistics(data, u_phi, (), self.__chunk_size())
+        u_state = self.__m_step(data, state, u_phi, statistics)
+        if u_state.geo_factors is None:
+            return u_state
 
-            for feature in self.h_arrays.keys():
-                u_h_arrays[feature] = self.__update_eta_conjugate_gd_optimized(data[feature], self.m_arrays[feature],
-                                                                               self.h_arrays[feature], u_phi)
-                dh += np.max(np.abs(u_h_arrays[feature] - self.h_arrays[feature]))
+        try:
+            # the geographical log probabilities only change with the regions
+            u_log_terms = self.__log_terms(data, u_state.beta_arrays, u_state.geo_factors,
+                                           state.log_terms.location_log_likelihood if self.fixed_regions else None)
+        except:
+            traceback.print_stack(file=sys.stderr)
+            return u_state
 
-                u_beta_arrays[feature] = self.get_topic_unigram(self.m_arrays[feature], u_h_arrays[feature])
+        return self.__with_likelihood(data, u_state, u_log_terms)
 
-            # likelihood_old = likelihood
+    def __m_step(self, data, state: EMState, u_phi, statistics: SufficientStatistics):
+        """
+        M-step from the responsibilities of the E-step and their sufficient statistics. The expected unigram counts are
+        computed from data and u_phi if the statistics do not have them.
+
+        :return: EMState of the updated parameters, without log-likelihood terms and likelihood. Its geo_factors are
+        None if the updated covariances are invalid
+        """
+        u_theta, u_topic_centers, u_topic_covar = self.__parameters_from_statistics(statistics)
+
+        if not self.fixed_regions:
+            u_theta, u_topic_centers, u_topic_covar = self.__recover_regions(statistics.sum_phi, u_theta,
+                                                                             u_topic_centers, u_topic_covar,
+                                                                             data["coordinates"])
 
             try:
-                u_statistics = self.compute_likelihood(data, u_topic_centers, u_topic_covar,
-                                                       u_theta, u_phi, u_h_arrays, u_beta_arrays, self.Lambda)
-            except:
-                # cannot compute likelihood
-                # TODO why? no convergence? --MM
-                traceback.print_stack(file=sys.stderr)
-                self.__log("Cannot compute likelihood", 0)
-
-                # just report whatever we had from before
-                self.__update_stats(self.latest_statistics)
-                break
+                u_geo_factors = self.compute_geo_factors(u_topic_centers, u_topic_covar)
+            except utils.Error:
+                return EMState(u_theta, u_topic_centers, u_topic_covar, state.h_arrays, state.beta_arrays, None, None,
+                               u_phi, None)
+        else:
+            u_topic_centers = state.topic_centers
+            u_topic_covar = state.topic_covar
+            u_geo_factors = state.geo_factors
+
+        # update eta and beta, features are independent given phi
+        u_h_arrays, u_beta_arrays = self.__update_features(data, u_phi, statistics.sparse_and_phi or None,
+                                                           h_arrays=state.h_arrays)
+
+        return EMState(u_theta, u_topic_centers, u_topic_covar, u_h_arrays, u_beta_arrays, u_geo_factors, None, u_phi,
+                       None)
+
+    def __with_likelihood(self, data, u_state: EMState, u_log_terms):
+        """
+        :return: u_state with the log-likelihood terms of its parameters and its likelihood, both None if the
+        likelihood cannot be computed
+        """
+        try:
+            u_statistics = self.compute_likelihood(data, u_state.topic_centers, u_state.topic_covar,
+                                                   u_state.theta, u_state.phi, u_state.h_arrays, u_state.beta_arrays,
+                                                   self.Lambda, u_state.geo_factors, u_log_terms, self.__chunk_size())
+        except:
+            traceback.print_stack(file=sys.stderr)
+            return u_state
+
+        return u_state._replace(log_terms=u_log_terms, statistics=u_statistics)
+
+    def __squarem_step(self, data, state: EMState):
+        """
+        SQUAREM (Varadhan and Roland, 2008): runs two EM steps p1 = F(p0) and p2 = F(p1), extrapolates the parameters
+        to p0 - 2 a r + a^2 v, with r = p1 - p0, v = p2 - 2 p1 + p0 and a = -|r| / |v|, and runs a stabilizing EM step
+        from there. Falls back to p2 if the extrapolated parameters are invalid or the bound is lower than at p2.
+
+        :return: the accepted EMState and the number of EM steps that were run
+        """
+        state_1 = self.__em_step(data, state)
+        if state_1.statistics is None:
+            return state_1, 1
+
+        state_2 = self.__em_step(data, state_1)
+        if state_2.statistics is None:
+            return state_2, 2
+
+        features = sorted(state.h_arrays.keys())
+        arrays_0, arrays_1, arrays_2 = [[s.theta, s.topic_centers, s.topic_covar] + [s.h_arrays[f] for f in features]
+                                        for s in (state, state_1, state_2)]
+
+        r = [array_1 - array_0 for array_0, array_1 in zip(arrays_0, arrays_1)]
+        v = [array_2 - 2.0 * array_1 + array_0 for array_0, array_1, array_2 in zip(arrays_0, arrays_1, arrays_2)]
+
+        norm_v = np.sqrt(sum(np.sum(np.square(array)) for array in v))
+        if norm_v == 0:
+            return state_2, 2
+
+        # a = -1 gives p2 back
+        alpha = min(-np.sqrt(sum(np.sum(np.square(array)) for array in r)) / norm_v, -1.0)
+        if alpha == -1.0:
+            return state_2, 2
+
+        u_arrays = [array_0 - 2.0 * alpha * r_array + alpha * alpha * v_array
+                    for array_0, r_array, v_array in zip(arrays_0, r, v)]
+        u_theta, u_topic_centers, u_topic_covar = u_arrays[:3]
+        u_h_arrays = dict(zip(features, u_arrays[3:]))
+
+        # the extrapolated covariances must stay positive definite, and the topic proportions positive
+        determinants = u_topic_covar[:, 0, 0] * u_topic_covar[:, 1, 1] - u_topic_covar[:, 0, 1] * u_topic_covar[:, 1, 0]
+        if np.any(u_theta <= 0) or np.any(u_topic_covar[:, 0, 0] <= 0) or np.any(determinants <= 0):
+            self.__log("Extrapolated parameters are invalid, taking the plain EM steps", 2)
+            return state_2, 2
+
+        u_theta = u_theta / np.sum(u_theta)
+
+        u_beta_arrays = dict((feature, self.get_topic_unigram(self.m_arrays[feature], u_h_arrays[feature],
+                                                              self.dtype))
+                             for feature in features)
+
+        if self.fixed_regions:
+            u_geo_factors = state.geo_factors
+        else:
+            try:
+                u_geo_factors = utils.gaussian_factors(u_topic_centers, u_topic_covar)
+            except utils.Error:
+                self.__log("Extrapolated covariances are invalid, taking the plain EM steps", 2)
+                return state_2, 2
+
+        u_log_terms = self.__log_terms(data, u_beta_arrays, u_geo_factors,
+                                       state.log_terms.location_log_likelihood if self.fixed_regions else None)
+
+        state_3 = self.__em_step(data, EMState(u_theta, u_topic_centers, u_topic_covar, u_h_arrays, u_beta_arrays,
+                                               u_geo_factors, u_log_terms, None, None))
+
+        if state_3.statistics is None or state_3.statistics.likelihood < state_2.statistics.likelihood:
+            self.__log("Extrapolation lowers the bound, taking the plain EM steps", 2)
+            return state_2, 3
+
+        return state_3, 3
+
+    @staticmethod
+    def __run_restarts(models, data, num_iterations):
+        """
+        Runs the EM iterations of fit_restarts, one EM step of all the restarts that are not trained yet at a time.
+        """
+        last_iterations = [model.max_iterations if num_iterations is None
+                           else min(model.max_iterations, model.num_iterations + num_iterations) for model in models]
+
+        active = [r for r, model in enumerate(models) if not model.is_trained() and
+                  model.num_iterations < last_iterations[r]]
+
+        # the stacked log-likelihood terms of an iteration are reused by the one after the next
+        workspace = Workspace()
+
+        states = [EMState(model.theta, model.topic_centers, model.topic_covar, model.h_arrays, model.beta_arrays,
+                          model.get_geo_factors(), None, model.phi, model.latest_statistics) for model in models]
+        log_terms, restart_log_terms = Model.__restart_log_terms([models[r] for r in active], data,
+                                                                 [states[r] for r in active], workspace)
+        for r, terms in zip(active, restart_log_terms):
+            states[r] = states[r]._replace(log_terms=terms)
+
+        while active:
+            restarts = [models[r] for r in active]
+            restart_states = [states[r] for r in active]
+            for model in restarts:
+                model.__log("[k = {0}] At iteration {1}".format(model.num_topics, model.num_iterations + 1), 1)
+
+            # E-Step of every restart into the rows of its topics
+            offsets = np.cumsum([0] + [state.theta.shape[1] for state in restart_states])
+            num_points = data["coordinates"].shape[0]
+            phi = None
+            if restarts[0].spatial_tolerance is None and not restarts[0].__truncates_phi():
+                phi = np.empty((offsets[-1], num_points), restarts[0].dtype)
+
+            restart_phis = [model.__responsibilities(state.log_terms, state.theta,
+                                                     None if phi is None else phi[start:stop])
+                            for model, state, start, stop in zip(restarts, restart_states, offsets[:-1], offsets[1:])]
+            if phi is None:
+                phi = sparse.vstack(restart_phis, format="csr")
+
+            # M-Step of every restart, from the sufficient statistics of all of them
+            statistics = Model.compute_sufficient_statistics(data, phi, list(restarts[0].h_arrays.keys()),
+                                                             restarts[0].__chunk_size(offsets[-1]))
+            u_states = [model.__m_step(data, state, restart_phi, Model.__topic_rows(statistics, slice(start, stop)))
+                        for model, state, restart_phi, start, stop in zip(restarts, restart_states, restart_phis,
+                                                                          offsets[:-1], offsets[1:])]
+
+            # log-likelihood terms of the updated parameters, for the likelihood and the next E-step
+            valid = [i for i, u_state in enumerate(u_states) if u_state.geo_factors is not None]
+            u_log_terms, restart_log_terms = Model.__restart_log_terms([restarts[i] for i in valid], data,
+                                                                       [u_states[i] for i in valid], workspace)
+
+            for i, terms in zip(valid, restart_log_terms):
+                u_states[i] = restarts[i].__with_likelihood(data, u_states[i], terms)
+
+            for r, model, state, u_state in zip(active, restarts, restart_states, u_states):
+                states[r] = model.__register_step(data, state, u_state, 1)
+
+            active = [r for r in active if states[r] is not None and models[r].num_iterations < last_iterations[r]]
+
+            # no state refers to the terms of the previous parameters anymore
+            if log_terms is not None:
+                workspace.release(log_terms.feature_log_likelihood, log_terms.location_log_likelihood)
+            if u_log_terms is None or log_terms is None or \
+                    u_log_terms.feature_log_likelihood.shape != log_terms.feature_log_likelihood.shape:
+                workspace.clear()
+            log_terms = u_log_terms
+
+    @staticmethod
+    def __restart_log_terms(models, data, states, workspace):
+        """
+        Computes the log-likelihood terms of the parameters of several restarts together, for all their topics.
+
+        :param states: EMState with the parameters of every restart
+        :param workspace: Workspace the dense stacked terms are taken from
+        :return: the stacked LogLikelihoodTerms (None if sparse or if there are no restarts), and the LogLikelihoodTerms
+        of every restart, on the rows of its topics
+        """
+        if not states:
+            return None, []
+
+        offsets = np.cumsum([0] + [state.theta.shape[1] for state in states])
+        beta_arrays = dict((feature, np.vstack([state.beta_arrays[feature] for state in states]))
+                           for feature in states[0].beta_arrays.keys())
+        geo_factors = GeoFactors(*[np.concatenate(field) for field in zip(*[state.geo_factors for state in states])])
+
+        spatial_tolerance = models[0].spatial_tolerance
+
+        if spatial_tolerance is None:
+            shape = (offsets[-1], data["coordinates"].shape[0])
+            dtype = models[0].dtype
+            log_terms = Model.compute_log_terms(data, beta_arrays, geo_factors,
+                                                chunk_size=models[0].__chunk_size(offsets[-1]),
+                                                out=LogLikelihoodTerms(workspace.empty(shape, dtype),
+                                                                       workspace.empty(shape, dtype)))
+
+            return log_terms, [LogLikelihoodTerms(log_terms.feature_log_likelihood[start:stop],
+                                                  log_terms.location_log_likelihood[start:stop])
+                               for start, stop in zip(offsets[:-1], offsets[1:])]
+
+        log_terms = Model.compute_sparse_log_terms(data, beta_arrays, geo_factors, spatial_tolerance,
+                                                   groups=[slice(start, stop)
+                                                           for start, stop in zip(offsets[:-1], offsets[1:])])
+
+        return None, [LogLikelihoodTerms(log_terms.feature_log_likelihood[start:stop],
+                                         log_terms.location_log_likelihood[start:stop],
+                                         utils.gaussian_log_pdf_sum(data["coordinates"], state.geo_factors))
+                      for state, start, stop in zip(states, offsets[:-1], offsets[1:])]
+
+    @staticmethod
+    def __topic_rows(statistics: SufficientStatistics, rows):
+        """
+        :return: the SufficientStatistics of the given slice of topics
+        """
+        return SufficientStatistics(*[dict((feature, value[rows]) for feature, value in field.items())
+                                      if isinstance(field, dict) else field[rows] for field in statistics])
+
+    def __run_stochastic_EM(self, data, num_passes):
+        """
+        Stochastic EM: every mini-batch of points is used for an E-step, whose sufficient statistics, scaled to the
+        whole data, are blended into running statistics with step size (step + offset) ^ -decay. The global parameters
+        are then re-estimated from the running statistics.
+        """
+        num_points = data["coordinates"].shape[0]
+        features = list(self.h_arrays.keys())
+        batch_size = self.batch_size
+
+        for em_step in range(self.num_iterations, self.num_iterations + num_passes):
+            self.__log("[k = {0}] At pass {1}".format(self.num_topics, em_step + 1), 1)
+
+            order = self.__get_random_state().permutation(num_points)
+
+            for start in range(0, num_points, batch_size):
+                batch = self.__subset(data, order[start:start + batch_size], features)
+                batch_points = batch["coordinates"].shape[0]
+
+                # E-Step on the batch
+                log_terms = self.__log_terms(batch, self.beta_arrays, self.get_geo_factors())
+                batch_phi = self.__responsibilities(log_terms, self.theta)
+                batch_statistics = self.compute_sufficient_statistics(batch, batch_phi, features)
+
+                weight = (self.stochastic_step + self.learning_rate_offset) ** -self.learning_rate_decay
+                self.running_statistics = self.__blend_statistics(self.running_statistics, batch_statistics, weight,
+                                                                  float(num_points) / batch_points)
+                self.stochastic_step += 1
+
+                # M-Step from the running statistics
+                u_theta, u_topic_centers, u_topic_covar = self.__parameters_from_statistics(self.running_statistics)
+
+                if not self.fixed_regions:
+                    u_theta, u_topic_centers, u_topic_covar = self.__recover_regions(
+                        self.running_statistics.sum_phi, u_theta, u_topic_centers, u_topic_covar,
+                        data["coordinates"])
+
+                self.theta = u_theta
+
+                if not self.fixed_regions:
+                    self.geo_factors = self.compute_geo_factors(u_topic_centers, u_topic_covar)
+                    self.topic_centers = u_topic_centers
+                    self.topic_covar = u_topic_covar
+
+                self.h_arrays, self.beta_arrays = self.__update_features(batch, batch_phi,
+                                                                         self.running_statistics.sparse_and_phi)
+
+            u_statistics = self.__streaming_statistics(data, batch_size, features)
 
             dlikelihood = np.abs(u_statistics.likelihood - self.latest_statistics.likelihood)
 
-            # register the updates
-            self.phi = u_phi
-            self.theta = u_theta
+            self.num_iterations += 1
+            self.__update_stats(u_statistics)
+            self.__prune_topics()
+
+            self.__log("EM pass {0}, {1}".format(em_step + 1, u_statistics[0:7]), 2)
+
+            if abs(dlikelihood / u_statistics.likelihood) < self.minimum_relative_change:
+                self.converged = True
+                break
+
+            self.__checkpoint()
+
+    def shard_step(self, data, phi=None, e_step=True):
+        """
+        Step of a worker of sharded EM, see fit_sharded: computes the log-likelihood terms of the current parameters on
+        a shard, the bound terms of the responsibilities of the previous step under them, and the E-step.
+
+        :param data: the shard, a dictionary containing coordinates and sparse N x V_F matrices for features
+        :param phi: responsibilities of the previous step on the shard, None on the first step
+        :param e_step: if False, only the bound terms are computed and phi is kept
+        :return: BoundTerms of phi or None, SufficientStatistics of the E-step (with the expected unigram counts of
+        all features) or None, and the responsibilities of the E-step
+        """
+        log_terms = self.__log_terms(data, self.beta_arrays, self.get_geo_factors())
+
+        bound_terms = None
+        if phi is not None:
+            bound_terms = self.compute_bound_terms(log_terms, self.theta, phi, self.__chunk_size())
+
+        statistics = None
+        if e_step:
+            u_phi = self.__responsibilities(log_terms, self.theta)
+            statistics = self.compute_sufficient_statistics(data, u_phi, list(self.beta_arrays.keys()),
+                                                            self.__chunk_size())
+
+            if phi is not u_phi:
+                self.__release(phi)
+            phi = u_phi
+
+        self.__release(log_terms.feature_log_likelihood, log_terms.location_log_likelihood)
+
+        return bound_terms, statistics, phi
+
+    def __run_sharded_EM(self, transport, num_iterations):
+        """
+        Full-batch EM over the shards of fit_sharded. The likelihood of an iteration needs the log-likelihood terms of
+        its parameters, so the workers send it back with the E-step of the next iteration.
+        """
+        statistics, _ = self.__map_shards(transport, reset=True)
+        last_iteration = self.num_iterations + num_iterations
+
+        while self.num_iterations < last_iteration:
+            self.__log("[k = {0}] At iteration {1}".format(self.num_topics, self.num_iterations + 1), 1)
+
+            # M-Step from the statistics of all shards
+            u_theta, u_topic_centers, u_topic_covar = self.__parameters_from_statistics(statistics)
+
             if not self.fixed_regions:
+                u_theta, u_topic_centers, u_topic_covar = self.__recover_regions(statistics.sum_phi, u_theta,
+                                                                                 u_topic_centers, u_topic_covar,
+                                                                                 self.shard_coordinates)
+                try:
+                    self.geo_factors = self.compute_geo_factors(u_topic_centers, u_topic_covar)
+                except utils.Error:
+                    self.__log("Cannot compute likelihood", 0)
+
+                    # keep the parameters of the last iteration, and do not try again on resume
+                    self.__update_stats(self.latest_statistics)
+                    self.converged = True
+                    break
+
                 self.topic_centers = u_topic_centers
                 self.topic_covar = u_topic_covar
-            self.h_arrays = u_h_arrays
-            self.beta_arrays = u_beta_arrays
 
+            self.theta = u_theta
+            self.h_arrays, self.beta_arrays = self.__update_features(None, None, statistics.sparse_and_phi)
+
+            # E-step of the updated parameters, along with the likelihood of this iteration
+            statistics, bound_terms = self.__map_shards(transport, e_step=self.num_iterations + 1 < last_iteration)
+            u_statistics = self.statistics_from_bound_terms(bound_terms, self.topic_centers, self.topic_covar,
+                                                            self.h_arrays, self.Lambda)
+
+            dlikelihood = np.abs(u_statistics.likelihood - self.latest_statistics.likelihood)
+
+            self.num_iterations += 1
             self.__update_stats(u_statistics)
+            pruned = self.__prune_topics()
 
-            self.__log("EM step {0}, {1}".format(em_step + 1, u_statistics[0:7]), 2)
+            self.__log("EM step {0}, {1}".format(self.num_iterations, u_statistics[0:7]), 2)
 
             if abs(dlikelihood / u_statistics.likelihood) < self.minimum_relative_change:
+                self.converged = True
                 break
 
-    def __update_eta_conjugate_gd_optimized(self, sparse_doc_term_matrix, m_array, h_array, phi):
+            self.__checkpoint()
+
+            if pruned and self.num_iterations < last_iteration:
+                # the statistics are those of the topics before pruning
+                statistics, _ = self.__map_shards(transport, reset=True)
+
+    def __map_shards(self, transport, reset=False, e_step=True):
+        """
+        Runs shard_step on all workers with the current parameters and adds up their results.
+
+        :param reset: if True, the workers drop the responsibilities of their previous step
+        :return: SufficientStatistics and BoundTerms of all shards, None if not computed
+        """
+        replica = self.__shard_replica()
+        statistics = None
+        bound_terms = None
+
+        for shard_bound_terms, shard_statistics in transport.map("step", [(replica, reset, e_step)] *
+                                                                         transport.num_shards):
+            statistics = self.__add_statistics(statistics, shard_statistics)
+            bound_terms = self.__add_statistics(bound_terms, shard_bound_terms)
+
+        return statistics, bound_terms
+
+    def __shard_replica(self):
+        """
+        :return: a shallow copy of the model with what shard_step needs, without the unigram frequencies, the eta arrays
+        and the histories
+        """
+        replica = copy(self)
+        replica.m_arrays = {}
+        replica.h_arrays = {}
+        replica.a_gammas = {}
+        replica.b_gammas = {}
+        replica.phi = None
+        replica.running_statistics = None
+        replica.shard_coordinates = None
+        replica.track_params = False
+
+        for name in list(vars(replica).keys()):
+            if name.endswith("_history"):
+                delattr(replica, name)
+
+        return replica
+
+    @staticmethod
+    def __add_statistics(total, value):
+        """
+        Adds up the SufficientStatistics or the BoundTerms of two shards, in place in the arrays of total. Either can
+        be None.
+        """
+        if total is None or value is None:
+            return value if total is None else total
+
+        fields = []
+        for total_field, field in zip(total, value):
+            if isinstance(total_field, dict):
+                for feature in total_field.keys():
+                    total_field[feature] += field[feature]
+            elif isinstance(total_field, np.ndarray):
+                total_field += field
+            else:
+                total_field = total_field + field
+
+            fields.append(total_field)
+
+        return type(total)(*fields)
+
+    @staticmethod
+    def __concatenate_samples(samples):
+        """
+        :param samples: data sets with the same unigrams
+        :return: a data set with the venues of all samples
+        """
+        samples = list(samples)
+        features = utils.features_of(samples[0])
+
+        data = dict((feature, sparse.vstack([sample[feature] for sample in samples], format="csr"))
+                    for feature in features)
+        data["coordinates"] = np.vstack([sample["coordinates"] for sample in samples])
+        data["unigrams"] = samples[0]["unigrams"]
+
+        return data
+
+    def __prune_topics(self):
+        """
+        Drops the topics whose proportion is below min_topic_proportion and merges the pairs of topics whose Gaussians
+        are within merge_distance, see Model. A topic is merged at most once per call.
+
+        :return: True if the topics changed
+        """
+        min_topic_proportion = self.min_topic_proportion
+        merge_distance = self.merge_distance
+
+        theta = self.theta.ravel()
+        kept = np.nonzero(theta >= min_topic_proportion)[0]
+        if kept.shape[0] == 0:
+            kept = np.array([np.argmax(theta)])
+
+        groups = [[z] for z in kept]
+
+        if merge_distance > 0 and not self.fixed_regions and kept.shape[0] > 1:
+            distances = utils.bhattacharyya_distances(self.topic_centers[kept], self.topic_covar[kept])
+            pairs = np.transpose(np.nonzero(np.triu(distances < merge_distance, k=1)))
+
+            merged = set()
+            groups = []
+            for i, j in sorted(pairs, key=lambda pair: distances[pair[0], pair[1]]):
+                if i not in merged and j not in merged:
+                    groups.append([kept[i], kept[j]])
+                    merged.update([i, j])
+
+            groups += [[z] for i, z in enumerate(kept) if i not in merged]
+
+        if len(groups) == self.num_topics:
+            return False
+
+        self.__log("[k = {0}] Pruned {1} and merged {2} topics".format(
+            self.num_topics, self.num_topics - kept.shape[0], kept.shape[0] - len(groups)), 1)
+
+        self.__merge_topics(groups)
+
+        return True
+
+    def __merge_topics(self, groups):
+        """
+        Resizes all the per topic arrays to the given groups of topics. The topics of a group add up their
+        proportions, phi and sufficient statistics, average their eta arrays weighted by theta and are replaced by
+        their moment-matched Gaussian.
+
+        :param groups: list of the topic indices that make up every new topic
+        """
+        theta = self.theta.ravel()
+        weights = [theta[group] / np.sum(theta[group]) for group in groups]
+
+        if not self.fixed_regions:
+            topic_centers = np.array([weight.dot(self.topic_centers[group]) for group, weight in zip(groups, weights)])
+
+            topic_covar = np.empty((len(groups), 2, 2))
+            for z, (group, weight) in enumerate(zip(groups, weights)):
+                diff = self.topic_centers[group] - topic_centers[z]  # g x 2
+                topic_covar[z] = np.einsum('g,gij->ij', weight, self.topic_covar[group]) + \
+                                 np.einsum('g,gi,gj->ij', weight, diff, diff)
+
+            self.topic_centers = topic_centers
+            self.topic_covar = topic_covar
+        else:
+            # user-supplied regions are only dropped
+            self.topic_centers = self.topic_centers[[group[0] for group in groups]]
+            self.topic_covar = self.topic_covar[[group[0] for group in groups]]
+        self.geo_factors = self.compute_geo_factors(self.topic_centers, self.topic_covar)
+
+        u_theta = np.array([np.sum(theta[group]) for group in groups])
+        self.theta = np.reshape(u_theta / np.sum(u_theta), (1, len(groups)))  # 1 x k
+
+        for feature in self.h_arrays.keys():
+            self.h_arrays[feature] = np.array([weight.dot(self.h_arrays[feature][group])
+                                               for group, weight in zip(groups, weights)])  # k x V
+            self.beta_arrays[feature] = self.get_topic_unigram(self.m_arrays[feature], self.h_arrays[feature],
+                                                               self.dtype)
+
+        self.a_gammas = copy(self.h_arrays)
+        for feature in self.a_gammas.keys():
+            self.a_gammas[feature] = np.abs(self.a_gammas[feature])
+        self.b_gammas = np.copy(self.a_gammas)
+
+        if self.phi is not None:
+            # sums the rows of every group, for a dense or a sparse phi
+            grouping = sparse.csr_matrix((np.ones(sum(len(group) for group in groups)),
+                                          ([z for z, group in enumerate(groups) for _ in group],
+                                           [topic for group in groups for topic in group])),
+                                         shape=(len(groups), self.num_topics))
+            self.phi = grouping.dot(self.phi)  # k x N
+
+        # the sum of phi squares of merged topics misses their cross terms, it only corrects the covariances
+        if self.running_statistics is not None:
+            self.running_statistics = SufficientStatistics(
+                *[dict((feature, np.array([np.sum(value[group], axis=0) for group in groups]))
+                       for feature, value in field.items())
+                  if isinstance(field, dict) else np.array([np.sum(field[group], axis=0) for group in groups])
+                  for field in self.running_statistics])
+
+        self.num_topics = len(groups)
+
+    def __streaming_statistics(self, data, batch_size, features):
+        """
+        Computes the likelihood of the current parameters batch by batch, without storing phi for all points.
         """
-        Uses conjugate gradient descent from scipy to find the best eta array. Pre-computes stuff not to repeat them.
+        geo_factors = self.get_geo_factors()
+        bound_terms = None
+
+        for start in range(0, data["coordinates"].shape[0], batch_size):
+            batch = self.__subset(data, np.arange(start, min(start + batch_size, data["coordinates"].shape[0])),
+                                  features)
+
+            log_terms = self.__log_terms(batch, self.beta_arrays, geo_factors)
+            batch_bound_terms = self.compute_bound_terms(log_terms, self.theta,
+                                                         self.__responsibilities(log_terms, self.theta),
+                                                         self.__chunk_size())
+
+            bound_terms = batch_bound_terms if bound_terms is None \
+                else BoundTerms(*[total + value for total, value in zip(bound_terms, batch_bound_terms)])
 
-        h_array, beta_array: k x V
-        phi: k x N array
-        sparse_doc_term_matrix: matrix N x V
+        return self.statistics_from_bound_terms(bound_terms, self.topic_centers, self.topic_covar, self.h_arrays,
+                                                self.Lambda)
+
+    @staticmethod
+    def __subset(data, indices, features):
+        """
+        Selects the given points from the coordinates and the sparse feature matrices.
         """
+        subset = dict((feature, data[feature][indices]) for feature in features)
+        subset["coordinates"] = data["coordinates"][indices]
 
-        # also equals "e" in the derivative, we don't want to transpose the sparse matrix, k x V
-        sparse_and_phi = phi * sparse_doc_term_matrix
-        E = np.sum(sparse_and_phi, axis=1)  # 1 x k
+        if utils.STACKED_FEATURES in data:
+            subset[utils.STACKED_FEATURES] = data[utils.STACKED_FEATURES][indices]
+            subset[utils.STACKED_COLUMNS] = data[utils.STACKED_COLUMNS]
 
-        def compute_log_beta(h_matrix):
-            beta_array = m_array + h_matrix
-            norm_sum = utils.log_sum(beta_array, axis=1)
+        return subset
 
-            return beta_array - norm_sum[:, np.newaxis]
+    def __update_features(self, data, phi, sparse_and_phi_arrays=None, h_arrays=None):
+        """
+        Updates the eta and beta arrays of all features, concurrently on the configured pool.
 
-        def l_prime(h_new):
-            h_new_matrix = h_new.reshape(h_array.shape)
+        :param data: a dictionary containing coordinates and sparse N x V_F matrices for features
+        :param phi: k x N array
+        :param sparse_and_phi_arrays: F x k x V expected unigram counts per topic, computed from data and phi if not
+        given
+        :param h_arrays: F x k x V eta arrays to start the solvers from, the current ones if not given
+        :return: updated h_arrays and beta_arrays (F x k x V)
+        """
+        feature_n_jobs = self.feature_n_jobs
+        if h_arrays is None:
+            h_arrays = self.h_arrays
+        features = list(h_arrays.keys())
+
+        if sparse_and_phi_arrays is None and utils.STACKED_COLUMNS in data:
+            # a single product with the stacked layout of the features instead of one per feature
+            sparse_and_phi_arrays = self.__feature_products(data, phi, features)
+
+        def update_feature(feature):
+            if sparse_and_phi_arrays is not None:
+                sparse_and_phi = sparse_and_phi_arrays[feature]
+            else:
+                sparse_and_phi = self.__feature_products(data, phi, [feature])[feature]
 
-            new_beta = np.exp(compute_log_beta(h_new_matrix))
-            # g = 1. / (h_new_matrix + _EPSILON) + (E * new_beta.T).T - sparse_and_phi  # multiplied by -1 to maximize
-            g = self.Lambda * np.sign(h_new_matrix) + (
-                E * new_beta.T).T - sparse_and_phi  # multiplied by -1 to maximize
-            # g = (E * new_beta.T).T - sparse_and_phi  # multiplied by -1 to maximize
+            # the solvers work in float64, their tolerances are below the resolution of float32
+            sparse_and_phi = np.asarray(sparse_and_phi, dtype=np.float64)
 
-            return g.flatten()
+            h_array = self.__update_eta(sparse_and_phi, self.m_arrays[feature], h_arrays[feature])
+            return h_array, self.get_topic_unigram(self.m_arrays[feature], h_array, self.dtype)
 
-        def f(h_new):
-            h_new_matrix = h_new.reshape(h_array.shape)
+        num_workers = min(len(features), effective_n_jobs(feature_n_jobs)) * \
+                      effective_n_jobs(self.eta_n_jobs)
 
-            new_beta_log = compute_log_beta(h_new_matrix)
-            # result = np.sum(new_beta_log * sparse_and_phi)
-            # result = np.sum(new_beta_log * sparse_and_phi) - np.sum(
-            #    np.log(np.abs(h_new + _EPSILON)))  # Matrix .* matrix
-            result = np.sum(new_beta_log * sparse_and_phi) - self.Lambda * np.sum(
-                np.abs(h_new))  # Matrix .* matrix
+        with utils.limit_blas_threads(num_workers):
+            updates = Parallel(n_jobs=feature_n_jobs, backend="threading")(
+                delayed(update_feature)(feature) for feature in features)
 
-            return -1.0 * result
+        u_h_arrays = dict((feature, h_array) for feature, (h_array, _) in zip(features, updates))
+        u_beta_arrays = dict((feature, beta_array) for feature, (_, beta_array) in zip(features, updates))
 
-        # Initialize beta_array
-        h_upd = optimize.fmin_cg(f, h_array.flatten(), fprime=l_prime, gtol=_EPSILON,
-                                 norm=np.inf, disp=(self.verbose == 2))
+        return u_h_arrays, u_beta_arrays
+
+    def __update_eta(self, sparse_and_phi, m_array, h_array):
+        """
+        Updates the eta array of a feature with the configured solver, solving the independent per-topic problems
+        on the configured pool.
 
-        # self.__log('check_grad: {}'.format(optimize.check_grad(f, l_prime, h_upd)), 2)
-        return h_upd.reshape(h_array.shape)
+        h_array: k x V
+        sparse_and_phi: k x V, phi * sparse_doc_term_matrix
+        """
+        return eta.solve(self.eta_solver, sparse_and_phi, m_array, h_array, self.Lambda, n_jobs=self.eta_n_jobs,
+                         backend=self.eta_backend, disp=(self.verbose == 2))
 
     def compute_beta_for_loc(self, loc, dimension='words'):
         """
@@ -612,20 +2234,9 @@ class Model:
         """
         # p(beta | loc) = \sum_z p(beta, z | loc) = 
         # \sum_z p(beta, z, loc) / p(loc) \propto \sum_z p(beta, loc | z) p(z)
+        geo_prob = np.exp(utils.gaussian_log_pdf(np.reshape(loc, (1, 2)), self.get_geo_factors()))  # k x 1
 
-        # TODO Speed up -- MM
-
-        k = self.topic_centers.shape[0]
-        geo_rv = [stats.multivariate_normal(mean=self.topic_centers[z, :],
-                                            cov=self.topic_covar[z, :, :],
-                                            allow_singular=True) for z in range(k)]
-        # TODO store these in the model? -MM
-
-
-        beta = np.zeros_like(self.beta_arrays[dimension][0])  # (1 x V)
-        for z in range(k):
-            beta += self.theta[0, z] * geo_rv[z].pdf(loc) * \
-                    self.beta_arrays[dimension][z, :]
+        beta = (self.theta.T * geo_prob * self.beta_arrays[dimension]).sum(axis=0)  # (1 x V)
 
         # normalize
         beta = beta / np.sum(beta)
@@ -636,14 +2247,9 @@ class Model:
         Return the probability that the model generate a data point at alpha
         given location.
         """
-        k = self.topic_centers.shape[0]
-        geo_rv = [stats.multivariate_normal(mean=self.topic_centers[z, :],
-                                            cov=self.topic_covar[z, :, :],
-                                            allow_singular=True) for z in range(k)]
         # p(loc) = \sum_z p(loc | z) p(z)
-        geo_prob = [geo_rv[z].pdf(loc) for z in range(k)]
-        tmp = [self.theta[0, z] * geo_prob[z] for z in range(k)]
-        prob = np.sum(tmp)
+        geo_prob = np.exp(utils.gaussian_log_pdf(np.reshape(loc, (1, 2)), self.get_geo_factors()))  # k x 1
+        prob = np.sum(self.theta.T * geo_prob)
         return prob
 
     def __log(self, text, level):
@@ -664,3 +2270,4 @@ class Model:
             self.center_history.append(statistics.topic_centers)
             self.covar_history.append(statistics.topic_covar)
             self.phi_history.append(statistics.phi)
+            self.em_steps_history.append(self.num_iterations)
@@ -0,0 +1,284 @@
+"""
+Sharded EM: the venues are split into disjoint shards held by workers, which run the E-step of their shard and send
+back its sufficient statistics, see Model.fit_sharded. The model adds them up and runs the M-step.
+
+Workers are reached through a transport. ProcessTransport runs them in local processes, SocketTransport connects to
+workers that run serve, on other nodes or locally. Messages are pickles, so socket connections must be authenticated
+with a shared key, e.g. from secrets.token_bytes, which only the model and its workers know.
+"""
+import multiprocessing
+import sys
+import time
+import traceback
+from multiprocessing.connection import Client, Listener
+
+import numpy as np
+
+from model import utils, ShardSummary
+from model.workspace import Workspace
+
+# Seconds between the attempts of SocketTransport to connect to a worker that is not listening yet
+_CONNECT_INTERVAL = 0.1
+
+
+class Error(Exception):
+    pass
+
+
+def _check_authkey(authkey):
+    # multiprocessing.connection skips the authentication for an empty key
+    if not isinstance(authkey, bytes) or not authkey:
+        raise ValueError("Socket workers unpickle what they receive, they need a non-empty bytes authkey")
+
+
+class ShardWorker:
+    """
+    Holds a shard of the venues and the responsibilities of its last E-step, which never leave the worker.
+    """
+
+    def __init__(self, data: dict):
+        self.data = data
+        self.phi = None
+        self.num_topics = None
+
+        # the k x N arrays of every step are reused by the next one
+        self.workspace = Workspace()
+
+    def summary(self):
+        """
+        :return: ShardSummary of the shard, its unigram counts add up to those of all the data
+        """
+        return ShardSummary(self.data["coordinates"].shape[0],
+                            dict((feature, np.asarray(self.data[feature].sum(axis=0)).ravel())
+                                 for feature in utils.features_of(self.data)))
+
+    def sample(self, size, seed):
+        """
+        :return: a data set of size venues of the shard drawn at random, with their coordinates and feature matrices
+        """
+        num_points = self.data["coordinates"].shape[0]
+        indices = np.sort(np.random.default_rng(seed).choice(num_points, min(size, num_points), replace=False))
+
+        sample = dict((feature, self.data[feature][indices]) for feature in utils.features_of(self.data))
+        sample["coordinates"] = self.data["coordinates"][indices]
+        sample["unigrams"] = self.data["unigrams"]
+
+        return sample
+
+    def step(self, model, reset=False, e_step=True):
+        """
+        Runs Model.shard_step on the shard.
+
+        :param model: the model with the current parameters, see Model.shard_step
+        :param reset: if True, the responsibilities of the previous step are dropped, e.g. because the topics changed
+        :return: BoundTerms of the previous responsibilities or None, SufficientStatistics of the E-step or None
+        """
+        if reset:
+            self.phi = None
+
+        if model.num_topics != self.num_topics:
+            # arrays of the previous number of topics are not needed anymore
+            self.workspace.clear()
+            self.num_topics = model.num_topics
+
+        model.workspace = self.workspace
+        try:
+            bound_terms, statistics, self.phi = model.shard_step(self.data, self.phi, e_step)
+        finally:
+            model.workspace = None
+
+        return bound_terms, statistics
+
+
+def split_data(data: dict, num_shards):
+    """
+    Splits a data set into contiguous shards of about the same number of venues, with the same unigrams.
+
+    :return: list of data sets, the counts of every shard are those of its venues
+    """
+    features = utils.features_of(data)
+    shards = []
+
+    for indices in np.array_split(np.arange(data["coordinates"].shape[0]), num_shards):
+        shard = dict((feature, data[feature][indices]) for feature in features)
+        shard["coordinates"] = data["coordinates"][indices]
+        shard["unigrams"] = data["unigrams"]
+        shard["counts"] = dict((feature, np.asarray(shard[feature].sum(axis=0)).ravel().tolist())
+                               for feature in features)
+        shard["venue_ids"] = None if data.get("venue_ids") is None else \
+            [data["venue_ids"][i] for i in indices]
+
+        if utils.STACKED_FEATURES in data:
+            shard[utils.STACKED_FEATURES] = data[utils.STACKED_FEATURES][indices]
+            shard[utils.STACKED_COLUMNS] = data[utils.STACKED_COLUMNS]
+
+        shards.append(shard)
+
+    return shards
+
+
+def _load(shard):
+    # a shard is a data set, or a function loading it where the worker runs
+    return shard() if callable(shard) else shard
+
+
+def _serve_connection(connection, worker):
+    """
+    Calls the methods of worker that arrive on connection and sends their results back, until None arrives.
+    """
+    while True:
+        message = connection.recv()
+        if message is None:
+            break
+
+        method, arguments = message
+        try:
+            result = getattr(worker, method)(*arguments)
+        except Exception:
+            traceback.print_exc(file=sys.stderr)
+            connection.send((False, traceback.format_exc()))
+        else:
+            connection.send((True, result))
+
+
+def _serve_pipe(connection, shard):
+    try:
+        _serve_connection(connection, ShardWorker(_load(shard)))
+    finally:
+        connection.close()
+
+
+def serve(address, shard, authkey):
+    """
+    Runs the worker of a shard for a SocketTransport: waits for the connection of the model on address, serves it
+    until the transport is closed, and returns.
+
+    :param address: (host, port) to listen on
+    :param shard: data set of the shard, or a function loading it
+    :param authkey: non-empty bytes that the transport must present, see multiprocessing.connection
+    """
+    _check_authkey(authkey)
+    worker = ShardWorker(_load(shard))
+
+    with Listener(address, authkey=authkey) as listener:
+        with listener.accept() as connection:
+            _serve_connection(connection, worker)
+
+
+class ConnectionTransport:
+    """
+    Reaches one shard worker per connection. map sends a call to every worker before receiving any result, so that
+    the workers run concurrently.
+
+    Use as a context manager, the workers are stopped when it exits.
+    """
+
+    def __init__(self, connections):
+        self.connections = connections
+
+    @property
+    def num_shards(self):
+        return len(self.connections)
+
+    def map(self, method, arguments):
+        """
+        Calls a ShardWorker method on every worker.
+
+        :param method: name of the method
+        :param arguments: list of the argument tuples of every worker
+        :return: iterator over the results of the workers, in order. Results are received as they are consumed, so
+        that they can be added up without holding all of them. Raises Error if a worker failed
+        """
+        for connection, worker_arguments in zip(self.connections, arguments):
+            connection.send((method, worker_arguments))
+
+        return self.__receive()
+
+    def __receive(self):
+        failures = []
+
+        for shard, connection in enumerate(self.connections):
+            succeeded, result = connection.recv()
+            if not succeeded:
+                failures.append("Shard {0} failed:\n{1}".format(shard, result))
+            elif not failures:
+                yield result
+
+        # the results of all workers are received even after a failure, the connections stay in sync
+        if failures:
+            raise Error("\n".join(failures))
+
+    def close(self):
+        for connection in self.connections:
+            try:
+                connection.send(None)
+            except OSError:
+                pass
+            connection.close()
+
+        self.connections = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class ProcessTransport(ConnectionTransport):
+    """
+    Runs the worker of every shard in a local process, connected with a pipe.
+    """
+
+    def __init__(self, shards):
+        """
+        :param shards: data sets of the shards, or functions loading them in the worker processes
+        """
+        connections = []
+        self.processes = []
+
+        for shard in shards:
+            connection, worker_connection = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_serve_pipe, args=(worker_connection, shard), daemon=True)
+            process.start()
+            worker_connection.close()
+
+            connections.append(connection)
+            self.processes.append(process)
+
+        super().__init__(connections)
+
+    def close(self):
+        super().close()
+
+        for process in self.processes:
+            process.join()
+
+        self.processes = []
+
+
+class SocketTransport(ConnectionTransport):
+    """
+    Connects to workers that run serve, one address per shard.
+    """
+
+    def __init__(self, addresses, authkey, timeout=30.0):
+        """
+        :param addresses: (host, port) of the worker of every shard
+        :param authkey: non-empty bytes the workers expect, see serve
+        :param timeout: seconds to wait for a worker that is not listening yet
+        """
+        _check_authkey(authkey)
+        super().__init__([self.__connect(address, authkey, timeout) for address in addresses])
+
+    @staticmethod
+    def __connect(address, authkey, timeout):
+        deadline = time.monotonic() + timeout
+
+        while True:
+            try:
+                return Client(address, authkey=authkey)
+            except ConnectionRefusedError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(_CONNECT_INTERVAL)
@@ -0,0 +1,83 @@
+"""
+Placing data sets in shared memory, so that worker processes map the arrays instead of receiving pickled copies.
+"""
+from multiprocessing import shared_memory
+
+import numpy as np
+from scipy import sparse
+
+
+class SharedData:
+    """
+    Copies the coordinates and the CSR feature matrices of a data set into shared memory blocks, once. The
+    description can be sent to worker processes, which map the same blocks with attach_data. Everything else in the
+    data set (unigrams, counts, venue ids) is sent as is.
+
+    Use as a context manager, the blocks are released when the owner exits it.
+    """
+
+    def __init__(self, data: dict):
+        self.blocks = []
+        self.description = {}
+
+        for key, value in data.items():
+            if isinstance(value, np.ndarray) and value.dtype != object:
+                self.description[key] = ("array", self.__share(value))
+            elif sparse.isspmatrix_csr(value):
+                self.description[key] = ("csr", value.shape,
+                                         self.__share(value.data), self.__share(value.indices),
+                                         self.__share(value.indptr))
+            else:
+                self.description[key] = ("object", value)
+
+    def __share(self, array):
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        self.blocks.append(block)
+
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+
+        return block.name, array.shape, array.dtype.str
+
+    def close(self):
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+
+        self.blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def attach_data(description: dict):
+    """
+    Maps a data set shared with SharedData, without copying the arrays.
+
+    :param description: SharedData.description
+    :return: the data set, and the shared memory blocks that have to be kept referenced while it is used
+    """
+    blocks = []
+
+    def attach(array_description):
+        name, shape, dtype = array_description
+        block = shared_memory.SharedMemory(name=name)
+        blocks.append(block)
+
+        return np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+
+    data = {}
+
+    for key, value in description.items():
+        if value[0] == "array":
+            data[key] = attach(value[1])
+        elif value[0] == "csr":
+            _, shape, data_description, indices_description, indptr_description = value
+            data[key] = sparse.csr_matrix((attach(data_description), attach(indices_description),
+                                           attach(indptr_description)), shape=shape, copy=False)
+        else:
+            data[key] = value[1]
+
+    return data, blocks
@@ -1,18 +1,109 @@
+import os
 import sys
 import warnings
 
 import numpy as np
 import scipy as sp
-from model import ModelParameters
+from scipy import sparse
+from scipy.spatial import cKDTree
+from threadpoolctl import threadpool_limits
+
+from model import ModelParameters, GeoFactors
 
 
 def stop(): sys.exit()
 
 
+# Keys of the optional stacked layout of the feature matrices in a data set, see stack_features
+STACKED_FEATURES = "stacked_features"
+STACKED_COLUMNS = "stacked_columns"
+
+
 class Error(Exception):
     pass
 
 
+# Parallelism
+
+# Cores the BLAS threads of this process may use, fewer than all of them in a worker process, see share_cores
+_process_cores = None
+
+
+def share_cores(num_processes):
+    """
+    Limits the BLAS threads of this process to its share of the cores, when it is one of num_processes concurrent
+    worker processes, for as long as the process lives. limit_blas_threads then divides that share.
+    """
+    global _process_cores
+    _process_cores = max(1, (os.cpu_count() or 1) // num_processes)
+
+    return threadpool_limits(limits=_process_cores, user_api="blas")
+
+
+def limit_blas_threads(num_workers):
+    """
+    Limits the number of BLAS threads, so that num_workers concurrent workers that use BLAS do not oversubscribe the
+    cores of the process. Use as a context manager; nothing is limited for a single worker.
+    """
+    if num_workers <= 1:
+        return threadpool_limits(limits=None)
+
+    return threadpool_limits(limits=max(1, (_process_cores or os.cpu_count() or 1) // num_workers), user_api="blas")
+
+
+# Data
+def features_of(data: dict):
+    """
+    :return: names of the sparse feature matrices of a data set
+    """
+    return [key for key in data.keys()
+            if key not in ["coordinates", "counts", "unigrams", "venue_ids", STACKED_FEATURES, STACKED_COLUMNS]]
+
+
+def stack_features(data: dict, features=None):
+    """
+    Adds the feature matrices of a data set stacked horizontally into one CSR matrix, so that the products with all the
+    features are a single sparse product. The per feature matrices stay in the data set.
+
+    :param features: features to stack, all of them if not given
+    :return: copy of data with the N x (V_1 + ... + V_F) matrix under STACKED_FEATURES, and the column slice of every
+    feature in it under STACKED_COLUMNS
+    """
+    if features is None:
+        features = features_of(data)
+
+    columns = {}
+    start = 0
+    for feature in features:
+        columns[feature] = slice(start, start + data[feature].shape[1])
+        start = columns[feature].stop
+
+    stacked = dict(data)
+    stacked[STACKED_FEATURES] = sparse.hstack([data[feature] for feature in features], format="csr")
+    stacked[STACKED_COLUMNS] = columns
+
+    return stacked
+
+
+def stack_columns(arrays: dict, columns: dict):
+    """
+    Stacks per feature k x V_F arrays horizontally, in the layout of a stacked feature matrix, see stack_features.
+    """
+    return np.hstack([arrays[feature] for feature in sorted(columns.keys(), key=lambda feature: columns[feature].start)])
+
+
+def chunks(num_points, chunk_size=None):
+    """
+    Splits num_points into consecutive blocks of at most chunk_size points, a single block if chunk_size is None.
+
+    :return: list of slices
+    """
+    if chunk_size is None:
+        return [slice(0, num_points)]
+
+    return [slice(start, min(start + chunk_size, num_points)) for start in range(0, max(num_points, 1), chunk_size)]
+
+
 # Math
 def my_log(x):
     if x == 0.:
@@ -21,7 +112,8 @@ def my_log(x):
 
 
 def log_sum(x, axis):
-    return np.logaddexp.reduce(x, axis)
+    # accumulated in float64 at least, also for float32 arrays
+    return np.logaddexp.reduce(x, axis, dtype=np.promote_types(np.asarray(x).dtype, np.float64))
 
 
 def log_sum_scipy(x, axis):
@@ -54,6 +146,222 @@ def log_sum_slow(x_array):
     return log_s
 
 
+def sum_rows(matrix):
+    """
+    Sums the rows of a dense array or a sparse matrix, in float64.
+
+    :return: 1-D array
+    """
+    return np.asarray(matrix.sum(axis=1, dtype=np.float64)).ravel()
+
+
+def floor_covariances(topic_covar, min_variance):
+    """
+    Raises the eigenvalues of 2D covariance matrices to at least min_variance, so that topics concentrated on a few
+    locations keep invertible covariances.
+
+    :param topic_covar: k x 2 x 2 symmetric matrices
+    :return: floored covariances (k x 2 x 2)
+    """
+    eigenvalues, eigenvectors = np.linalg.eigh(topic_covar)  # k x 2, k x 2 x 2
+
+    if np.all(eigenvalues >= min_variance):
+        return topic_covar
+
+    eigenvalues = np.maximum(eigenvalues, min_variance)
+
+    return np.einsum('kij,kj,klj->kil', eigenvectors, eigenvalues, eigenvectors)
+
+
+def bhattacharyya_distances(topic_centers, topic_covar):
+    """
+    Computes the Bhattacharyya distances between all pairs of 2D Gaussians.
+
+    :param topic_centers: k x 2
+    :param topic_covar: k x 2 x 2
+    :return: k x k distances
+    """
+    mean_covar = 0.5 * (topic_covar[:, np.newaxis] + topic_covar[np.newaxis, :])  # k x k x 2 x 2
+    diff = topic_centers[:, np.newaxis] - topic_centers[np.newaxis, :]  # k x k x 2
+
+    mean_det = np.linalg.det(mean_covar)  # k x k
+    det = np.linalg.det(topic_covar)  # k
+
+    mahalanobis = np.einsum('abi,abij,abj->ab', diff, np.linalg.inv(mean_covar), diff)
+
+    return 0.125 * mahalanobis + 0.5 * np.log(mean_det / np.sqrt(np.outer(det, det)))
+
+
+def gaussian_factors(topic_centers, topic_covar):
+    """
+    Pre-computes the closed-form precision matrices and log-normalizers of 2D Gaussians, so that they can be
+    evaluated for all topics at once with gaussian_log_pdf.
+
+    :param topic_centers: k x 2
+    :param topic_covar: k x 2 x 2
+    :return: GeoFactors with precision matrices (k x 2 x 2) and log-normalizers (k,)
+    """
+    var_xx = topic_covar[:, 0, 0]
+    var_yy = topic_covar[:, 1, 1]
+    cov_xy = 0.5 * (topic_covar[:, 0, 1] + topic_covar[:, 1, 0])
+
+    if not np.all(np.isfinite(topic_covar)):
+        raise Error("Non-finite covariance for topics {0}".format(
+            np.nonzero(~np.all(np.isfinite(topic_covar), axis=(1, 2)))[0].tolist()))
+
+    det = var_xx * var_yy - cov_xy * cov_xy  # k
+
+    # Same threshold as scipy.stats.multivariate_normal for eigenvalues that are treated as zero
+    singular = ~(det > 1e6 * np.finfo(float).eps * np.square(var_xx + var_yy))
+    det[singular] = 1.0
+
+    precision = np.empty_like(topic_covar)
+    precision[:, 0, 0] = var_yy / det
+    precision[:, 1, 1] = var_xx / det
+    precision[:, 0, 1] = precision[:, 1, 0] = -cov_xy / det
+
+    log_norm = -np.log(2.0 * np.pi) - 0.5 * np.log(det)  # k
+
+    if np.any(singular):
+        # Pseudo-inverse and pseudo-determinant, as multivariate_normal does with allow_singular=True
+        eigenvalues, eigenvectors = np.linalg.eigh(topic_covar[singular])  # s x 2, s x 2 x 2
+        tolerance = 1e6 * np.finfo(float).eps * np.max(np.abs(eigenvalues), axis=1, keepdims=True)
+
+        if np.any(eigenvalues < -tolerance):
+            raise Error("Covariance is not positive semi-definite for topics {0}".format(
+                np.nonzero(singular)[0][np.any(eigenvalues < -tolerance, axis=1)].tolist()))
+
+        kept = eigenvalues > tolerance
+        inverse_eigenvalues = np.where(kept, 1.0 / np.where(kept, eigenvalues, 1.0), 0.0)
+
+        precision[singular] = np.einsum('sij,sj,skj->sik', eigenvectors, inverse_eigenvalues, eigenvectors)
+        log_norm[singular] = -0.5 * (np.sum(kept, axis=1) * np.log(2.0 * np.pi)
+                                     + np.sum(np.log(np.where(kept, eigenvalues, 1.0)), axis=1))
+
+    return GeoFactors(topic_centers, topic_covar, precision, log_norm)
+
+
+def gaussian_log_pdf(coordinates, factors: GeoFactors, out=None):
+    """
+    Computes the log-density of every point under every topic Gaussian in one batched pass.
+
+    :param coordinates: N x 2
+    :param factors: GeoFactors for k topics, see gaussian_factors
+    :param out: k x N array to write the log-densities into, allocated if not given. They are computed in its dtype
+    :return: k x N matrix of log-densities
+    """
+    dtype = np.float64 if out is None else out.dtype
+
+    dx = np.subtract(coordinates[:, 0], factors.topic_centers[:, 0, np.newaxis], dtype=dtype)  # k x N
+    dy = np.subtract(coordinates[:, 1], factors.topic_centers[:, 1, np.newaxis], dtype=dtype)  # k x N
+
+    precision = factors.precision.astype(dtype, copy=False)
+
+    # Squared Mahalanobis distance: p_xx * dx^2 + 2 * p_xy * dx * dy + p_yy * dy^2
+    log_pdf = np.multiply(precision[:, 0, 0, np.newaxis] * dx, dx, out=out)
+    log_pdf += 2.0 * precision[:, 0, 1, np.newaxis] * dx * dy
+    log_pdf += precision[:, 1, 1, np.newaxis] * dy * dy
+
+    log_pdf *= -0.5
+    log_pdf += factors.log_norm[:, np.newaxis]
+
+    return log_pdf
+
+
+def gaussian_log_pdf_pairs(coordinates, factors: GeoFactors, topics, points):
+    """
+    Computes the log-density of the given pairs of topics and points only.
+
+    :param topics: P topic indices
+    :param points: P point indices
+    :return: P log-densities
+    """
+    diff = coordinates[points] - factors.topic_centers[topics]  # P x 2
+
+    return factors.log_norm[topics] - 0.5 * np.einsum('pi,pij,pj->p', diff, factors.precision[topics], diff)
+
+
+def gaussian_log_pdf_sum(coordinates, factors: GeoFactors):
+    """
+    Computes the sum of gaussian_log_pdf over all topics and points in closed form, without the k x N matrix.
+    """
+    num_points = coordinates.shape[0]
+    sum_x = np.sum(coordinates, axis=0)  # 2
+    sum_xx = coordinates.T.dot(coordinates)  # 2 x 2
+    centers = factors.topic_centers  # k x 2
+
+    # sum_n (x_n - mu)(x_n - mu)' per topic, k x 2 x 2
+    scatter = sum_xx - np.einsum('ki,j->kij', centers, sum_x) - np.einsum('i,kj->kij', sum_x, centers) \
+              + num_points * np.einsum('ki,kj->kij', centers, centers)
+
+    return np.sum(num_points * factors.log_norm - 0.5 * np.einsum('kij,kji->k', factors.precision, scatter))
+
+
+def gaussian_neighbors(coordinates, factors: GeoFactors, radius, tree=None, groups=None):
+    """
+    Finds the pairs of topics and points within the given Mahalanobis radius of the topic. Candidate points are
+    looked up in a KD-tree over the coordinates, within the radius times the largest standard deviation of every
+    topic, and then filtered by their exact distance. Points that are out of the radius of every topic are paired
+    with all topics.
+
+    :param radius: Mahalanobis radius, in standard deviations
+    :param tree: cKDTree over the coordinates, built if not given
+    :param groups: if given, slices of the topics of different models evaluated together. A point out of the radius
+    of every topic of a group is paired with all the topics of that group
+    :return: topic and point indices of the P pairs, sorted by topic and point, and their log-densities
+    """
+    num_topics = factors.topic_centers.shape[0]
+    num_points = coordinates.shape[0]
+
+    if tree is None:
+        tree = cKDTree(coordinates)
+    if groups is None:
+        groups = [slice(0, num_topics)]
+
+    max_deviations = np.sqrt(np.maximum(np.linalg.eigvalsh(factors.topic_covar)[:, -1], 0.0))  # k
+    neighbors = tree.query_ball_point(factors.topic_centers, radius * max_deviations)
+
+    topics = np.repeat(np.arange(num_topics), [len(topic_neighbors) for topic_neighbors in neighbors])
+    points = np.concatenate([np.asarray(topic_neighbors, dtype=int) for topic_neighbors in neighbors])
+    log_pdf = gaussian_log_pdf_pairs(coordinates, factors, topics, points)
+
+    kept = factors.log_norm[topics] - log_pdf <= 0.5 * radius * radius
+    topics, points, log_pdf = [topics[kept]], [points[kept]], [log_pdf[kept]]
+
+    for group in groups:
+        in_group = (topics[0] >= group.start) & (topics[0] < group.stop)
+        uncovered = np.nonzero(np.bincount(points[0][in_group], minlength=num_points) == 0)[0]
+
+        if uncovered.shape[0] > 0:
+            uncovered_topics = np.repeat(np.arange(group.start, group.stop), uncovered.shape[0])
+            uncovered_points = np.tile(uncovered, group.stop - group.start)
+
+            topics.append(uncovered_topics)
+            points.append(uncovered_points)
+            log_pdf.append(gaussian_log_pdf_pairs(coordinates, factors, uncovered_topics, uncovered_points))
+
+    topics, points, log_pdf = np.concatenate(topics), np.concatenate(points), np.concatenate(log_pdf)
+
+    order = np.lexsort((points, topics))
+
+    return topics[order], points[order], log_pdf[order]
+
+
+def sparse_log_sum(values, columns, num_columns):
+    """
+    Computes log(sum(exp(values))) of the values of every column, like log_sum over axis 0 of a sparse matrix whose
+    missing entries are minus infinity.
+
+    :param values: P values
+    :param columns: P column indices, every column must have a value
+    :return: num_columns sums
+    """
+    maxima = np.full(num_columns, -np.inf)
+    np.maximum.at(maxima, columns, values)
+
+    return maxima + np.log(np.bincount(columns, weights=np.exp(values - maxima[columns]), minlength=num_columns))
+
+
 # Printing
 
 def get_topic_labels(unigrams, parameters: ModelParameters):
@@ -0,0 +1,57 @@
+"""
+Reusing the arrays of EM iterations, so that the k x N arrays of every iteration do not go through the allocator and
+fault in fresh pages again.
+"""
+import weakref
+
+import numpy as np
+
+
+class Workspace:
+    """
+    Pool of the arrays a model allocates while it trains. Arrays are taken with empty and handed back with release
+    once nothing refers to them anymore, so that a later empty of the same shape and dtype reuses them instead of
+    allocating.
+    """
+
+    def __init__(self):
+        self.__free = {}  # (shape, dtype) -> released arrays
+        self.__owned = weakref.WeakValueDictionary()  # id -> array allocated by the workspace
+
+        # counters, to see how many arrays the pool saved
+        self.allocations = 0
+        self.reuses = 0
+
+    def empty(self, shape, dtype=float):
+        """
+        :return: an array of that shape and dtype with undefined contents, a released one if there is any
+        """
+        free = self.__free.get((tuple(shape), np.dtype(dtype)))
+        if free:
+            self.reuses += 1
+            return free.pop()
+
+        array = np.empty(shape, dtype)
+        self.__owned[id(array)] = array
+        self.allocations += 1
+
+        return array
+
+    def release(self, *arrays):
+        """
+        Hands arrays back to the pool, they must not be used anymore. None and arrays that the workspace did not
+        allocate are ignored.
+        """
+        for array in arrays:
+            if array is None or self.__owned.get(id(array)) is not array:
+                continue
+
+            free = self.__free.setdefault((array.shape, array.dtype), [])
+            if not any(released is array for released in free):
+                free.append(array)
+
+    def clear(self):
+        """
+        Drops the released arrays, e.g. when the number of topics changes and their shapes are not needed anymore.
+        """
+        self.__free.clear()
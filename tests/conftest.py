@@ -0,0 +1,40 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+import scipy.sparse as sp
+
+# the modules import the model package from the root of the repository, which is itself a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def make_data(num_points=600, num_unigrams=32, num_topics=4, seed=0):
+    """
+    :return: a data set of num_points venues around num_topics centers, each with a few words of its topic
+    """
+    rng = np.random.default_rng(seed)
+    centers = 3 * rng.normal(size=(num_topics, 2))
+    topics = rng.integers(num_topics, size=num_points)
+    coordinates = centers[topics] + 0.5 * rng.normal(size=(num_points, 2))
+
+    words_per_topic = num_unigrams // num_topics
+    words = np.zeros((num_points, num_unigrams))
+    for n, topic in enumerate(topics):
+        words[n, topic * words_per_topic + rng.choice(words_per_topic, 3)] += 1
+        words[n, rng.integers(num_unigrams)] += 1
+    words = sp.csr_matrix(words)
+
+    return {"coordinates": coordinates, "words": words, "counts": {"words": np.asarray(words.sum(axis=0)).ravel()},
+            "unigrams": {"words": ["w{0}".format(v) for v in range(num_unigrams)]},
+            "venue_ids": list(range(num_points))}
+
+
+@pytest.fixture
+def data():
+    return make_data()
+
+
+@pytest.fixture
+def test_data():
+    return make_data(num_points=200, seed=1)
@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+from model.model import Model
+
+NUM_ITERATIONS = 10
+
+
+@pytest.mark.parametrize("options, fit_options", [
+    ({}, {}),
+    ({"min_topic_proportion": 0.05}, {}),
+    ({"max_topics_per_point": 2}, {}),
+    ({}, {"batch_size": 150}),
+])
+def test_resume_from_checkpoint_reproduces_uninterrupted_run(tmp_path, data, options, fit_options):
+    path = str(tmp_path / "run.ckpt")
+
+    uninterrupted = Model(1.0, 4, NUM_ITERATIONS, 1e-12, track_params=True, random_state=np.random.default_rng(1),
+                          **options)
+    uninterrupted.fit(data, **fit_options)
+
+    interrupted = Model(1.0, 4, NUM_ITERATIONS, 1e-12, track_params=True, random_state=np.random.default_rng(1),
+                        checkpoint_path=path, checkpoint_every=2, **options)
+    interrupted.fit(data, num_iterations=5, **fit_options)
+
+    resumed = Model.load_checkpoint(path)
+    assert resumed.num_iterations == 5
+    assert resumed.phi is None
+
+    resumed.resume(data)
+
+    assert resumed.num_iterations == uninterrupted.num_iterations
+    assert resumed.likelihood_history == uninterrupted.likelihood_history
+
+
+def test_checkpoint_of_unseeded_model_restores_global_random_state(tmp_path, data):
+    path = str(tmp_path / "run.ckpt")
+
+    np.random.seed(0)
+    uninterrupted = Model(1.0, 4, NUM_ITERATIONS, 1e-12, track_params=True)
+    uninterrupted.fit(data, batch_size=150)
+
+    np.random.seed(0)
+    interrupted = Model(1.0, 4, NUM_ITERATIONS, 1e-12, track_params=True, checkpoint_path=path)
+    interrupted.fit(data, batch_size=150, num_iterations=5)
+    state = np.random.get_state()
+
+    # whatever draws from the global random state in between
+    np.random.seed(99)
+
+    resumed = Model.load_checkpoint(path)
+    assert all(np.array_equal(restored, saved) for restored, saved in zip(np.random.get_state(), state))
+
+    resumed.resume(data)
+
+    assert resumed.likelihood_history == uninterrupted.likelihood_history
@@ -0,0 +1,21 @@
+import numpy as np
+import pytest
+
+from model.model import Model
+
+
+@pytest.mark.parametrize("options", [
+    {},
+    {"max_topics_per_point": 2},
+    {"min_responsibility": 0.05},
+    {"spatial_tolerance": 1e-3},
+    {"spatial_tolerance": 1e-3, "max_topics_per_point": 2, "min_responsibility": 0.05},
+])
+def test_float32_model_keeps_phi_in_float32(data, options):
+    data["words"] = data["words"].astype(np.float32)
+
+    model = Model(1.0, 4, 3, 1e-12, dtype=np.float32, random_state=np.random.default_rng(0), **options)
+    model.fit(data)
+
+    assert model.phi.dtype == np.float32
+    assert all(beta_array.dtype == np.float32 for beta_array in model.beta_arrays.values())
@@ -0,0 +1,46 @@
+import pickle
+
+import numpy as np
+import pytest
+
+from model.model import Model
+
+# Attributes of the models pickled by the first release, before any of the options existed
+BASELINE_ATTRIBUTES = [
+    "Lambda", "num_topics", "max_iterations", "minimum_relative_change", "topic_centers", "topic_covar",
+    "fixed_regions", "m_arrays", "h_arrays", "beta_arrays", "theta", "phi", "a_gammas", "b_gammas", "track_params",
+    "verbose", "num_points", "likelihood_history", "user_likelihood_history", "location_likelihood_history",
+    "topic_likelihood_history", "sigma_likelihood_history", "phi_entropy_history", "center_history", "covar_history",
+    "h_array_history", "phi_history", "eta_penalty_history", "latest_statistics", "venue_ids",
+]
+
+
+def baseline_pickle(model):
+    """
+    :return: the pickle of a copy of model with the attributes of the first release only
+    """
+    baseline = Model.__new__(Model)
+    baseline.__dict__.update((name, value) for name, value in vars(model).items() if name in BASELINE_ATTRIBUTES)
+
+    return pickle.dumps(baseline)
+
+
+def test_baseline_pickle_predicts(data, test_data):
+    model = Model(1.0, 4, 6, 1e-12, track_params=True, random_state=np.random.default_rng(0))
+    model.fit(data)
+
+    loaded = pickle.loads(baseline_pickle(model))
+
+    assert loaded.predict_log_probs(test_data) == model.predict_log_probs(test_data)
+
+
+@pytest.mark.parametrize("track_params", [False, True])
+def test_baseline_pickle_gets_every_attribute(data, track_params):
+    """
+    __setstate__ must give old pickles every attribute that __init__ and training set.
+    """
+    model = Model(1.0, 4, 3, 1e-12, track_params=track_params, random_state=np.random.default_rng(0))
+    assert set(vars(model)) <= set(vars(pickle.loads(baseline_pickle(model))))
+
+    model.fit(data)
+    assert set(vars(model)) <= set(vars(pickle.loads(baseline_pickle(model))))
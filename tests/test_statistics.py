@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+from scipy import sparse
+
+from model.model import Model
+
+NUM_TOPICS = 5
+
+
+def multi_pass_m_step(data, phi):
+    """
+    The M-step as it was before the sufficient statistics: one pass over phi per parameter, and a second pass with
+    the updated centers for the covariances.
+
+    :return: theta (1 x k), topic_centers (k x 2), topic_covar (k x 2 x 2), expected unigram counts (k x V)
+    """
+    phi = phi.toarray() if sparse.issparse(phi) else np.asarray(phi, dtype=np.float64)
+    coordinates = data["coordinates"]
+
+    sum_phi = phi.sum(axis=1)
+    theta = (sum_phi / sum_phi.sum()).reshape((1, -1))
+    topic_centers = phi.dot(coordinates) / sum_phi[:, np.newaxis]
+
+    topic_covar = np.empty((phi.shape[0], 2, 2))
+    for z in range(phi.shape[0]):
+        diff = coordinates - topic_centers[z]
+        coeff = sum_phi[z] / (sum_phi[z] ** 2 - np.sum(phi[z] ** 2))
+        topic_covar[z] = coeff * (phi[z, :, np.newaxis] * diff).T.dot(diff)
+
+    return theta, topic_centers, topic_covar, np.asarray(sparse.csr_matrix(phi).dot(data["words"]).todense())
+
+
+def responsibilities(num_points, dtype=np.float64, max_topics_per_point=None):
+    phi = np.random.default_rng(0).dirichlet(np.ones(NUM_TOPICS), size=num_points).T  # k x N
+
+    if max_topics_per_point is not None:
+        # keep the largest responsibilities of every point, renormalized
+        smallest = np.argsort(phi, axis=0)[:NUM_TOPICS - max_topics_per_point]
+        np.put_along_axis(phi, smallest, 0.0, axis=0)
+        phi = sparse.csr_matrix(phi / phi.sum(axis=0))
+
+    return phi.astype(dtype)
+
+
+@pytest.mark.parametrize("dtype, chunk_size, max_topics_per_point", [
+    (np.float64, None, None),
+    (np.float64, 97, None),
+    (np.float32, None, None),
+    (np.float64, None, 2),
+])
+def test_one_pass_statistics_give_the_multi_pass_m_step(data, dtype, chunk_size, max_topics_per_point):
+    phi = responsibilities(data["coordinates"].shape[0], dtype, max_topics_per_point)
+    data["words"] = data["words"].astype(dtype)
+
+    statistics = Model.compute_sufficient_statistics(data, phi, ["words"], chunk_size)
+    theta, topic_centers, topic_covar = Model._Model__parameters_from_statistics(statistics)
+
+    expected_theta, expected_centers, expected_covar, expected_counts = multi_pass_m_step(data, phi)
+
+    tolerance = 1e-5 if dtype == np.float32 else 1e-10
+    np.testing.assert_allclose(theta, expected_theta, rtol=tolerance)
+    np.testing.assert_allclose(topic_centers, expected_centers, rtol=tolerance, atol=tolerance)
+    np.testing.assert_allclose(topic_covar, expected_covar, rtol=tolerance, atol=tolerance)
+    np.testing.assert_allclose(np.asarray(statistics.sparse_and_phi["words"]), expected_counts, rtol=tolerance)
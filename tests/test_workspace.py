@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+
+import model.model
+from model.model import Model
+from model.workspace import Workspace
+
+
+class NoReuseWorkspace(Workspace):
+    """
+    Workspace that never reuses an array, as if full-batch EM allocated all its arrays.
+    """
+
+    def release(self, *arrays):
+        pass
+
+
+@pytest.fixture
+def workspaces(monkeypatch):
+    """
+    :return: a function that fits a model with a workspace class and returns the model and its workspace
+    """
+
+    def fit(data, workspace_class, num_iterations, **options):
+        created = []
+
+        def record(*args):
+            created.append(workspace_class(*args))
+            return created[-1]
+
+        monkeypatch.setattr(model.model, "Workspace", record)
+        fitted = Model(1.0, 4, num_iterations, 1e-12, random_state=np.random.default_rng(0), **options)
+        fitted.fit(data)
+
+        assert len(created) == 1
+        return fitted, created[0]
+
+    return fit
+
+
+@pytest.mark.parametrize("options", [{}, {"dtype": np.float32}])
+def test_workspace_reuses_the_arrays_of_em_iterations(data, workspaces, options):
+    short, short_workspace = workspaces(data, Workspace, 4, **options)
+    long, long_workspace = workspaces(data, Workspace, 12, **options)
+    plain, plain_workspace = workspaces(data, NoReuseWorkspace, 12, **options)
+
+    print("{0}: {1} arrays allocated and {2} reused in 12 iterations, {3} allocated without reuse".format(
+        options, long_workspace.allocations, long_workspace.reuses, plain_workspace.allocations))
+
+    # reusing the arrays does not change the result
+    assert long.latest_statistics.likelihood == plain.latest_statistics.likelihood
+
+    # the arrays are allocated by the first iterations only, the next ones take them all from the pool
+    assert long_workspace.allocations == short_workspace.allocations
+    assert long_workspace.reuses > short_workspace.reuses
+    assert plain_workspace.reuses == 0
+    assert plain_workspace.allocations == long_workspace.allocations + long_workspace.reuses
@@ -6,16 +6,18 @@ on data loaded from a mongodb database
 
 import argparse
 import gc
+import os
 import sys
-import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 import matplotlib.pyplot as plt
 import numpy as np
-from joblib import Parallel, delayed
+from joblib import Parallel, delayed, effective_n_jobs
 
-from model import io, plotting
-from model.model import Model
-from model.utils import print_stuff
+from model import io, plotting, shared, sharded, utils
+from model.model import Model, ETA_SOLVERS, INITIALIZATIONS
+from model.utils import print_stuff, stack_features
 from mongo import get_mongo_database_with_auth
 
 
@@ -75,8 +77,94 @@ def parse_args():
         help = 'Relative change in likelihood.')
     parser.add_argument('--step', '-s', type=int, default=1,
         help = 'Iterations step.')
+    parser.add_argument('--batch_size', type=int, default=None,
+        help = "Run stochastic EM on mini-batches of that many venues. "
+            "If not given, full-batch EM is used.")
+    parser.add_argument('--lr_offset', type=float, default=1.0,
+        help = "Offset tau of the stochastic EM step sizes (t + tau)^-kappa.")
+    parser.add_argument('--lr_decay', type=float, default=0.7,
+        help = "Decay kappa of the stochastic EM step sizes, in (0.5, 1].")
+    parser.add_argument('--eta_solver', choices=ETA_SOLVERS, default="cg",
+        help = "Optimizer for the L1-penalized eta update: conjugate gradient "
+            "(cg) or proximal gradient descent (fista).")
+    parser.add_argument('--eta_jobs', type=int, default=1,
+        help = "Number of workers solving the per-topic eta problems, "
+            "as in joblib (-1 uses all cores).")
+    parser.add_argument('--eta_backend', choices=["threading", "loky"],
+        default="threading",
+        help = "Run the per-topic eta workers on threads or processes.")
+    parser.add_argument('--feature_jobs', type=int, default=1,
+        help = "Number of threads updating different features concurrently "
+            "in the M-step, as in joblib (-1 uses all cores).")
+    parser.add_argument('--init', choices=INITIALIZATIONS, default="random",
+        help = "Initialization of the regions: random draws around the mean "
+            "of the data, or k-means++ seeding refined with a few mini-batch "
+            "k-means iterations, which also initialize theta and eta.")
+    parser.add_argument('--init_feature_weight', type=float, default=0.0,
+        help = "Weight of the normalized features next to the coordinates "
+            "in the k-means initialization, 0 clusters coordinates only.")
+    parser.add_argument('--min_topic_proportion', type=float, default=0.0,
+        help = "Drop the topics whose proportion falls below that after an "
+            "iteration. 0 keeps all topics.")
+    parser.add_argument('--merge_distance', type=float, default=0.0,
+        help = "Merge the topics whose Gaussians are closer than that "
+            "Bhattacharyya distance after an iteration. 0 never merges.")
+    parser.add_argument('--phi_top_m', type=int, default=None,
+        help = "Keep the responsibilities of the m most likely topics of "
+            "every venue only, in a sparse phi. If not given, phi is dense.")
+    parser.add_argument('--phi_threshold', type=float, default=0.0,
+        help = "Drop the responsibilities below that from a sparse phi.")
+    parser.add_argument('--spatial_tolerance', type=float, default=None,
+        help = "Only evaluate a topic at the venues where its density is at "
+            "least that times its peak, found with a KD-tree, in training "
+            "and in the test likelihoods of model selection. If not given, "
+            "all topics are evaluated at all venues.")
+    parser.add_argument('--memory_budget', type=float, default=None,
+        help = "Megabytes of temporaries per model on top of phi; the E-step, "
+            "the likelihood and the covariance update then process the "
+            "venues in chunks that fit in it. If not given, all venues are "
+            "processed at once.")
+    parser.add_argument('--dtype', choices=['float64', 'float32'],
+        default='float64',
+        help = "Floating point type of the feature matrices, phi, the "
+            "log-likelihood terms and the beta arrays. float32 halves their "
+            "memory; sums and the eta solvers stay in float64.")
+    parser.add_argument('--stack_features', action='store_true',
+        help = "Also keep the feature matrices stacked into one sparse "
+            "matrix, so that the log-likelihoods and the expected counts "
+            "are a single sparse product instead of one per feature.")
+    parser.add_argument('--shards', type=int, default=None,
+        help = "Split the training venues into that many shards, each held "
+            "by a worker process that runs the E-step of its shard, while "
+            "the M-step runs on the sums of their sufficient statistics. "
+            "phi is then never stored in one process.")
+    parser.add_argument('--batch_restarts', action='store_true',
+        help = "Train the runs of a (lambda, k) configuration together in "
+            "one process, with their topics stacked, so that they share "
+            "every pass over the sparse feature matrices.")
+    parser.add_argument('--accelerate', action='store_true',
+        help = "Accelerate full-batch EM with SQUAREM extrapolation. "
+            "Iterations then count EM steps.")
+    parser.add_argument('--checkpoint_dir', default=None,
+        help = "Directory to save the training state of every (lambda, k, "
+            "run) to while EM runs, so that a run that dies can be resumed. "
+            "If not given, nothing is saved before the end.")
+    parser.add_argument('--checkpoint_every', type=int, default=None,
+        help = "EM iterations between checkpoints.")
+    parser.add_argument('--checkpoint_seconds', type=float, default=None,
+        help = "Seconds between checkpoints. If neither this nor "
+            "--checkpoint_every is given, a checkpoint is saved after every "
+            "iteration.")
+    parser.add_argument('--resume', action='store_true',
+        help = "Continue every (lambda, k, run) from its checkpoint in "
+            "--checkpoint_dir, if there is one. The data and the seed must "
+            "be those of the interrupted training.")
     parser.add_argument('--prefix', '-p', help = 'output filename')
     parser.add_argument('--external', '-e', help = 'external topic provider')
+    parser.add_argument('--warm_start', '-w', default=None,
+        help = "Filename prefix of a model saved with --save. Training "
+            "continues from its parameters instead of a random "
+            "initialization, with its vocabularies remapped to the data.")
     parser.add_argument('--plot', action='store_true',
         help = "Plot data points")
     parser.add_argument('--trackparams', action='store_true',
@@ -88,6 +176,35 @@ def parse_args():
         help = "Provide geo distribution")
     parser.add_argument('--runs', type=int, default=1,
         help = "Number of different runs - useful with random initialization")
+    parser.add_argument('--restart_backend', choices=["processes", "threading"],
+        default="processes",
+        help = "Run the different runs on worker processes, which map the "
+            "training data from shared memory, or on threads.")
+    parser.add_argument('--restart_jobs', type=int, default=-2,
+        help = "Number of workers for the different runs, as in joblib "
+            "(-2 leaves one core unused).")
+    parser.add_argument('--race', action='store_true',
+        help = "Race the runs of all (lambda, k) configurations with "
+            "successive halving: train them a few iterations at a time and "
+            "stop the ones that lag behind the leaders.")
+    parser.add_argument('--race_iterations', type=int, default=5,
+        help = "EM iterations of every run before the first pruning.")
+    parser.add_argument('--race_factor', type=int, default=2,
+        help = "Every pruning keeps 1/factor of the runs of a configuration "
+            "and of the configurations, and the survivors are trained factor "
+            "times more iterations before the next one.")
+    parser.add_argument('--k_path', action='store_true',
+        help = "Start the runs of every k after the first from the best "
+            "model of the previous k, with its topics of largest mass "
+            "split, instead of a random initialization.")
+    parser.add_argument('--lambda_path', choices=["decreasing", "increasing"],
+        default=None,
+        help = "Go through the lambdas in that order and start every lambda "
+            "after the first from the best model of the previous one, with "
+            "the same k, instead of a random initialization.")
+    parser.add_argument('--seed', type=int, default=None,
+        help = "Seed of the random streams of the runs. If not given, a "
+            "fresh seed is drawn and printed.")
     parser.add_argument('-xc', type=float, nargs='*',
         help = 'centers in x dimension')
     parser.add_argument('-yc', type=float, nargs='*',
@@ -106,6 +223,34 @@ def main():
     import persistent as p
     args, parser = parse_args()
 
+    if args.race and args.k_path:
+        parser.error("--race trains all k at once, it cannot follow a k path")
+    if args.race and args.lambda_path:
+        parser.error("--race trains all lambdas at once, it cannot follow a "
+            "lambda path")
+    if args.shards and (args.race or args.warm_start or args.batch_size or
+                        args.accelerate):
+        parser.error("--shards runs plain full-batch EM from a fresh "
+            "initialization, it cannot be combined with --race, "
+            "--warm_start, --batch_size or --accelerate")
+    if args.resume and not args.checkpoint_dir:
+        parser.error("--resume needs the --checkpoint_dir of the interrupted "
+            "training")
+    if args.resume and args.batch_restarts:
+        parser.error("--resume continues the runs one by one, it cannot be "
+            "combined with --batch_restarts")
+    if args.batch_restarts and (args.race or args.warm_start or
+                                args.batch_size or args.accelerate or
+                                args.shards or args.k_path or
+                                args.lambda_path):
+        parser.error("--batch_restarts runs plain full-batch EM from fresh "
+            "initializations, it cannot be combined with --race, "
+            "--warm_start, --batch_size, --accelerate, --shards, --k_path "
+            "or --lambda_path")
+
+    if args.checkpoint_dir:
+        os.makedirs(args.checkpoint_dir, exist_ok=True)
+
     # Get current time to use it as a filename for output files
     filename_prefix = "data/" + args.description
     # filename_prefix = datetime.today().strftime("%d-%m-%Y-%H.%M.%S")
@@ -128,12 +273,14 @@ def main():
     data, scaler = io.load_data_mongo(db[args.venuecoll],
         db[args.checkincoll], args.query, venue_extractors,
         checkin_extractors, filename_prefix, args.n_components,
-        args.venue_threshold)
+        args.venue_threshold, args.dtype)
 
 
     # Split into train and test
     train, test = io.split_train_test_with_common_vocabulary(data,
         test_size=0.2)
+    if args.stack_features:
+        train, test = stack_features(train), stack_features(test)
 
     print("Loaded {0} ({1} train, {2} test) data points.".format(
         data["coordinates"].shape[0], train["coordinates"].shape[0],
@@ -146,6 +293,14 @@ def main():
         initial_topic_centers, initial_topic_covar = \
             p.load_var('comparisons/{}_{}.preset'.format(city, args.external))
 
+    # continue from a previously trained model
+    warm_start = None
+    if args.warm_start:
+        warm_model, warm_scaler, warm_unigrams = io.load_model(args.warm_start)
+        # the regions were learned on coordinates standardized differently
+        warm_model.rescale_regions(warm_scaler, scaler)
+        warm_start = (warm_model, warm_unigrams)
+
     # Run EM n times
     best_train_likelihood = -1 * np.inf
     best_test_likelihood = -1 * np.inf
@@ -154,6 +309,9 @@ def main():
     best_model = None
 
     lambda_list = args.lambdas
+    if args.lambda_path:
+        lambda_list = sorted(lambda_list,
+                             reverse=(args.lambda_path == "decreasing"))
     k_list = range(args.k_min, 1 + args.k_max, args.k_step)
     train_likelihood_across_k = -np.inf * np.ones((len(lambda_list), len(k_list)))
     test_likelihood_across_k = -np.inf * np.ones((len(lambda_list), len(k_list)))
@@ -166,35 +324,83 @@ def main():
     if initial_topic_centers is not None:
         k_list = [len(initial_topic_centers)]
 
+    if warm_start is not None:
+        k_list = [warm_start[0].num_topics]
+
+    # every run gets an independent random stream
+    seed_sequence = np.random.SeedSequence(args.seed)
+    print("Random seed: {0}".format(seed_sequence.entropy), file=sys.stderr)
+
+    seeds = {}
+    for lidx in range(len(lambda_list)):
+        for kidx in range(len(k_list)):
+            seeds[(lidx, kidx)] = seed_sequence.spawn(args.runs)
+
+    def restarts_of(lidx, kidx, warm_start):
+        return [(lambda_list[lidx], k_list[kidx], i, args,
+                 initial_topic_centers, initial_topic_covar, track_params,
+                 warm_start, np.random.default_rng(child_seed))
+                for i, child_seed in enumerate(seeds[(lidx, kidx)])]
+
+    restarts = dict((configuration, restarts_of(*configuration, warm_start))
+                    for configuration in seeds.keys())
+    if warm_start is not None and not args.batch_size:
+        # full-batch EM from the same model, the runs would all be the same
+        restarts = dict((configuration, calls[:1])
+                        for configuration, calls in restarts.items())
+
+    executor = RestartExecutor(train, args.restart_backend, args.restart_jobs)
+
+    if args.race:
+        raced_models = race(executor, test, restarts, args)
+
+    # best model per k of the previous lambda on the path
+    previous_lambda_models = {}
+
     for lidx, Lambda in enumerate(lambda_list):
+        # best model of the last k of this lambda that did not fail, which
+        # the next k on the path splits
+        previous_k_model = None
 
         for kidx, num_topics in enumerate(k_list):
             print("\n====== lambda = {0}, k = {1} ======\n\n".format(Lambda,
                  num_topics), file=sys.stderr)
 
-            # n_jobs=-2 -> Leave only one logical core unused
-            models = Parallel(n_jobs=-2, backend="threading")(
-                delayed(run)(train, Lambda, num_topics, i, args,
-                             initial_topic_centers, initial_topic_covar,
-                             track_params) for i in
-                range(args.runs))
-
-            # TODO remove this or add command line option
-            # Swap to this for serial processing
-            # models = [run(train, Lambda, num_topics, i, args,
-            #               initial_topic_centers, initial_topic_covar,
-            #               track_params)
-            #           for i in range(args.runs)]
+            if args.race:
+                models = raced_models[(lidx, kidx)]
+            elif args.lambda_path and kidx in previous_lambda_models:
+                # continue from the best model of the previous lambda, the
+                # runs would all be the same
+                models = executor.run(run, restarts_of(lidx, kidx,
+                    (previous_lambda_models[kidx], None))[:1])
+            elif args.k_path and previous_k_model is not None:
+                # split the best model of the previous k on the path
+                models = executor.run(run, restarts_of(lidx, kidx,
+                    (previous_k_model, None)))
+            elif args.batch_restarts:
+                models = run_batched(train, restarts[(lidx, kidx)])
+            else:
+                models = executor.run(run, restarts[(lidx, kidx)])
+
+            models = [model for model in models if model is not None]
+            if not models:
+                print("All runs of lambda = {0}, k = {1} failed".format(
+                    Lambda, num_topics), file=sys.stderr)
+                continue
 
             best_model_index_for_parameters = np.argmax(
                 [model.latest_statistics.likelihood for model in models])
 
             best_model_in_k = models[best_model_index_for_parameters]
+            previous_k_model = best_model_in_k
+            if args.lambda_path:
+                previous_lambda_models[kidx] = best_model_in_k
 
             train_likelihood_across_k[lidx][kidx] = \
                 best_model_in_k.latest_statistics.likelihood
             test_likelihood_for_parameters = \
-                best_model_in_k.predict_log_probs(test)
+                best_model_in_k.predict_log_probs(test,
+                                                  args.spatial_tolerance)
             test_likelihood_across_k[lidx][kidx] = \
                 test_likelihood_for_parameters
 
@@ -208,6 +414,12 @@ def main():
 
             gc.collect()
 
+    executor.close()
+
+    if best_model is None:
+        sys.exit("Every run of every lambda and k failed, or none has a "
+                 "finite test likelihood, there is no model to report")
+
     print("Results of the best model:\n", file=sys.stderr)
     print_stuff(data["unigrams"], best_model.get_params())
     print("Best train likelihood: {0}\n".format(best_train_likelihood),
@@ -263,24 +475,303 @@ def main():
         plt.show()
 
 
+class RestartExecutor:
+    """
+    Runs the different runs of a (lambda, k) configuration, either on threads
+    or on worker processes. The training data is placed in shared memory once,
+    and every worker process maps it instead of receiving a copy.
+    """
+
+    def __init__(self, data, backend, n_jobs):
+        self.data = data
+        self.shared_data = None
+        self.pool = None
+        self.n_jobs = effective_n_jobs(n_jobs)
+
+        if backend == "processes":
+            self.shared_data = shared.SharedData(data)
+            self.pool = ProcessPoolExecutor(max_workers=self.n_jobs,
+                initializer=_attach_worker_data,
+                initargs=(self.shared_data.description, self.n_jobs))
+
+    def run(self, function, calls):
+        """
+        :param function: run or advance, called with the data first
+        :param calls: list of arguments of function, without the data
+        :return: the trained models
+        """
+        if self.pool is None:
+            return Parallel(n_jobs=self.n_jobs, backend="threading")(
+                delayed(function)(self.data, *call) for call in calls)
+
+        futures = [self.pool.submit(_run_on_worker_data, function, *call)
+                   for call in calls]
+        return [future.result() for future in futures]
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.shared_data.close()
+
+
+# Training data of a worker process, mapped from shared memory. The blocks are
+# kept referenced for as long as the process lives, and so is the limit of
+# its BLAS threads.
+_worker_data = None
+_worker_blocks = None
+_worker_blas_limits = None
+
+
+def _attach_worker_data(description, num_workers):
+    global _worker_data, _worker_blocks, _worker_blas_limits
+    _worker_data, _worker_blocks = shared.attach_data(description)
+
+    # the workers share the cores instead of running a full BLAS pool each
+    _worker_blas_limits = utils.share_cores(num_workers)
+
+
+def _run_on_worker_data(function, *args):
+    return function(_worker_data, *args)
+
+
+def race(executor, test, restarts, args):
+    """
+    Successive halving over the runs of all (lambda, k) configurations. Every
+    run is trained args.race_iterations EM iterations. Then, within every
+    configuration, the runs with the lowest train likelihood are stopped,
+    keeping 1/args.race_factor of them, and so are the configurations whose
+    best run has the lowest test likelihood, as in the final model selection.
+    The survivors are trained args.race_factor times more iterations before
+    the next pruning, until they converge or reach args.iter iterations.
+
+    :param restarts: dictionary of the arguments of run() per configuration
+    :return: dictionary of the models per configuration, without phi. Runs
+    stopped within their configuration are None, they lost to a run that went
+    on. The best run of a stopped configuration is returned as it was when it
+    was pruned
+    """
+    factor = max(args.race_factor, 2)
+    num_iterations = args.race_iterations
+
+    configurations = list(restarts.keys())
+    calls = [restart + (num_iterations,) for configuration in configurations
+             for restart in restarts[configuration]]
+    trained = iter(executor.run(run_without_phi, calls))
+
+    models = dict((configuration, [next(trained) for _ in
+                                   restarts[configuration]])
+                  for configuration in configurations)
+    # runs that failed are not raced
+    alive = dict((configuration, [i for i, model in
+                                  enumerate(models[configuration])
+                                  if model is not None])
+                 for configuration in configurations)
+    alive = dict((configuration, indices)
+                 for configuration, indices in alive.items() if indices)
+
+    def stop(configuration, indices):
+        # stopped runs free their k x N arrays, they are not trained anymore
+        for i in indices:
+            if not models[configuration][i].is_trained():
+                Lambda, num_topics = restarts[configuration][i][:2]
+                print("Stopped run {0} of lambda = {1}, k = {2} after {3} "
+                      "iterations".format(i, Lambda, num_topics,
+                      models[configuration][i].num_iterations),
+                      file=sys.stderr)
+
+            models[configuration][i] = None
+
+    while True:
+        # prune the runs that lag behind within their configuration
+        for configuration, indices in alive.items():
+            indices.sort(key=lambda i:
+                -models[configuration][i].latest_statistics.likelihood)
+            keep = max(1, len(indices) // factor)
+            stop(configuration, indices[keep:])
+            del indices[keep:]
+
+        # prune the configurations whose best run lags behind on test data
+        test_likelihoods = dict(
+            (configuration, models[configuration][indices[0]]
+                .predict_log_probs(test, args.spatial_tolerance))
+            for configuration, indices in alive.items())
+        ranked = sorted(alive.keys(),
+                        key=lambda configuration: -test_likelihoods[configuration])
+        for configuration in ranked[max(1, len(ranked) // factor):]:
+            indices = alive.pop(configuration)
+            best_model = models[configuration][indices[0]]
+            stop(configuration, indices)
+
+            # the best run is kept for the likelihoods across lambda and k
+            models[configuration][indices[0]] = best_model
+
+        advancing = [(configuration, i)
+                     for configuration, indices in alive.items()
+                     for i in indices
+                     if not models[configuration][i].is_trained()]
+        if not advancing:
+            return models
+
+        num_iterations *= factor
+        advanced = executor.run(advance,
+                                [(models[configuration][i], num_iterations)
+                                 for configuration, i in advancing])
+
+        for (configuration, i), model in zip(advancing, advanced):
+            models[configuration][i] = model
+
+
+def advance(data, model, num_iterations):
+    try:
+        model.resume(data, num_iterations)
+    except Exception:
+        # one failed run must not abort the other runs of the sweep
+        print("Run of lambda = {0}, k = {1} failed after {2} iterations, "
+              "stopping it:".format(model.Lambda, model.num_topics,
+              model.num_iterations), file=sys.stderr)
+        traceback.print_exc()
+
+        # the model keeps the parameters of its last complete iteration
+        model.converged = True
+
+    return without_phi(model)
+
+
+def run_without_phi(data, *args):
+    return without_phi(run(data, *args))
+
+
+def without_phi(model):
+    """
+    Drops the k x N responsibilities of a raced model, which resume recomputes
+    in its first E-step, so that the model goes between the processes of the
+    race without them.
+    """
+    if model is not None and model.latest_statistics is not None:
+        model.phi = None
+        model.latest_statistics = model.latest_statistics._replace(phi=None)
+
+    return model
+
+
+def checkpoint_path_of(args, Lambda, num_topics, num_initialization):
+    if not args.checkpoint_dir:
+        return None
+
+    return os.path.join(args.checkpoint_dir,
+        "lambda_{0}_k_{1}_run_{2}.ckpt".format(Lambda, num_topics,
+                                              num_initialization))
+
+
+def make_model(Lambda, num_topics, args, initial_topic_centers,
+        initial_topic_covar, track_params, random_state,
+        checkpoint_path=None):
+    return Model(Lambda, num_topics, args.iter, args.rel_change,
+        initial_topic_centers, initial_topic_covar,
+        track_params=track_params, verbose=args.verbose,
+        eta_solver=args.eta_solver, eta_n_jobs=args.eta_jobs,
+        eta_backend=args.eta_backend, feature_n_jobs=args.feature_jobs,
+        random_state=random_state, em_acceleration=args.accelerate,
+        initialization=args.init,
+        initialization_feature_weight=args.init_feature_weight,
+        min_topic_proportion=args.min_topic_proportion,
+        merge_distance=args.merge_distance,
+        max_topics_per_point=args.phi_top_m,
+        min_responsibility=args.phi_threshold,
+        spatial_tolerance=args.spatial_tolerance,
+        memory_budget=None if args.memory_budget is None
+            else int(args.memory_budget * 2 ** 20),
+        dtype=args.dtype, checkpoint_path=checkpoint_path,
+        checkpoint_every=args.checkpoint_every,
+        checkpoint_seconds=args.checkpoint_seconds)
+
+
 def run(data, Lambda, num_topics, num_initialization, args,
-        initial_topic_centers, initial_topic_covar, track_params):
+        initial_topic_centers, initial_topic_covar, track_params,
+        warm_start=None, random_state=None, num_iterations=None):
 
     print("\n=== [k = {0}] INITIALIZATION NUMBER {1} ===\n\n".format(num_topics,
         num_initialization))
 
-    # TODO add explanation in comment
-    seed = int(time.time() * 1e6 * (num_initialization + 1)) % int(time.time())
-    np.random.seed(seed)
+    # runs draw from their own streams, never from the global random state
+    if random_state is None:
+        random_state = np.random.default_rng()
+
+    checkpoint_path = checkpoint_path_of(args, Lambda, num_topics,
+        num_initialization)
+    resumed = args.resume and os.path.exists(checkpoint_path)
+
+    if resumed:
+        # the checkpoint has the options, the parameters and the random state
+        model = Model.load_checkpoint(checkpoint_path)
+        print("Resuming from {0} at iteration {1}".format(checkpoint_path,
+            model.num_iterations), file=sys.stderr)
+    else:
+        model = make_model(Lambda, num_topics, args, initial_topic_centers,
+            initial_topic_covar, track_params, random_state, checkpoint_path)
+
+    try:
+        if resumed and args.shards:
+            with sharded.ProcessTransport(
+                    sharded.split_data(data, args.shards)) as transport:
+                model.resume_sharded(transport, num_iterations=num_iterations)
+        elif resumed:
+            model.resume(data, num_iterations=num_iterations)
+        elif warm_start is not None:
+            warm_model, warm_unigrams = warm_start
+            model.warm_start(warm_model)
+            model.partial_fit(data, warm_unigrams, batch_size=args.batch_size,
+                learning_rate_offset=args.lr_offset,
+                learning_rate_decay=args.lr_decay,
+                num_iterations=num_iterations)
+        elif args.shards:
+            with sharded.ProcessTransport(
+                    sharded.split_data(data, args.shards)) as transport:
+                model.fit_sharded(transport, num_iterations=num_iterations)
+        else:
+            model.fit(data, batch_size=args.batch_size,
+                learning_rate_offset=args.lr_offset,
+                learning_rate_decay=args.lr_decay,
+                num_iterations=num_iterations)
+    except Exception:
+        # one failed run must not abort the other runs of the sweep
+        print("Run {0} of lambda = {1}, k = {2} failed, skipping it:".format(
+            num_initialization, Lambda, num_topics), file=sys.stderr)
+        traceback.print_exc()
+        return None
 
-    # Initialize model
-    model = Model(Lambda, num_topics, args.iter, args.rel_change,
-        initial_topic_centers, initial_topic_covar,
-        track_params=track_params, verbose=args.verbose)
+    return model
 
-    model.fit(data)
 
-    return model
+def run_batched(data, calls):
+    """
+    Trains the runs of a (lambda, k) configuration together, with their k x N
+    arrays stacked, see Model.fit_restarts.
+
+    :param calls: list of the arguments of run, without the data
+    :return: the trained models
+    """
+    models = [make_model(Lambda, num_topics, args, initial_topic_centers,
+                         initial_topic_covar, track_params, random_state,
+                         checkpoint_path_of(args, Lambda, num_topics,
+                                            num_initialization))
+              for Lambda, num_topics, num_initialization, args,
+                  initial_topic_centers, initial_topic_covar, track_params, _,
+                  random_state in calls]
+
+    print("\n=== [k = {0}] {1} BATCHED INITIALIZATIONS ===\n\n".format(
+        models[0].num_topics, len(models)))
+
+    try:
+        Model.fit_restarts(models, data)
+    except Exception:
+        print("Batched runs of lambda = {0}, k = {1} failed, skipping "
+            "them:".format(models[0].Lambda, models[0].num_topics),
+            file=sys.stderr)
+        traceback.print_exc()
+        return []
+
+    return models
 
 
 if __name__ == '__main__':